@@ -0,0 +1,131 @@
+# Written by Dr Daniel Buscombe, Marda Science LLC
+# for the USGS Coastal Change Hazards Program
+#
+# MIT License
+#
+# Copyright (c) 2023, Marda Science LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Times the per-image latency of model inference with the keras session cleared
+# after every image (how the estimators used to run) and with the session kept
+# for the whole run (how compute_segmentation runs now)
+
+# standard imports
+from tkinter import filedialog
+from tkinter import *
+import sys, os, time
+
+import numpy as np
+
+# local imports
+import model_inference_funcs
+from model_inference_funcs import K
+
+###### user variables
+####========================
+num_images = 20 ## number of images to time
+
+#===============================
+
+def baseline_predict(model, batch, MODEL, NCLASSES):
+    """runs model on a batch as the estimators used to: model.predict for binary models,
+    a direct call for the others"""
+    if MODEL=='segformer':
+        if NCLASSES == 2:
+            return model.predict(batch, batch_size=1).logits
+        return model(batch).logits
+    if NCLASSES == 2:
+        return model.predict(batch, batch_size=1)
+    return model(batch)
+
+
+def time_images(images, model_list, MODEL, NCLASSES, clear_session, num_warmup=1):
+    """returns the time (s) of the model calls of each image, through every model in model_list
+
+    With clear_session, each image goes through the old per-image path: the models are called
+    as the estimators used to (baseline_predict) and the keras session is cleared after every
+    model (NCLASSES > 2) or every image (NCLASSES == 2), and the clearing is timed with them.
+    Without, each image goes through model_predict alone. Resizing and argmax are not timed
+    in either arm, and the first num_warmup images are not timed
+    """
+    def predict(batch):
+        for model in model_list:
+            if clear_session:
+                baseline_predict(model, batch, MODEL, NCLASSES)
+                if NCLASSES > 2:
+                    K.clear_session()
+            else:
+                model_inference_funcs.model_predict(model, batch, MODEL)
+        if clear_session and NCLASSES == 2:
+            K.clear_session()
+
+    for image in images[:num_warmup]:
+        predict(np.asarray(image)[np.newaxis])
+
+    latencies = []
+    for image in images[num_warmup:]:
+        batch = np.asarray(image)[np.newaxis]
+        start = time.perf_counter()
+        predict(batch)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def print_latencies(name, latencies):
+    print("{}: first timed image {:.3f} s, median {:.3f} s, mean {:.3f} s per image".format(
+        name, latencies[0], np.median(latencies), np.mean(latencies)))
+
+
+if __name__ == "__main__":
+
+    root = Tk()
+    weights_files = list(filedialog.askopenfilenames(title = "Select weights file(s)",filetypes = (("weights file","*.h5"),("all files","*.*"))))
+    print(weights_files)
+    root.withdraw()
+
+    root = Tk()
+    root.filename = filedialog.askdirectory(title="Select directory of images to time")
+    sample_direc = root.filename
+    print(sample_direc)
+    root.withdraw()
+
+    config = model_inference_funcs.get_config(weights_files)
+    TARGET_SIZE = config.get("TARGET_SIZE")
+    NCLASSES = config.get("NCLASSES")
+    N_DATA_BANDS = config.get("N_DATA_BANDS")
+    MODEL = config.get("MODEL")
+
+    model, model_list, config_files, model_names = model_inference_funcs.get_model(weights_files)
+
+    files = model_inference_funcs.sort_files(sample_direc)[:num_images]
+    if len(files) < 2:
+        print("Need at least 2 images to time (the first is a warm-up)")
+        sys.exit(2)
+    print("Timing {} images with {} model(s)".format(len(files), len(model_list)))
+    images, sizes, bigimages = model_inference_funcs.decode_batch(files, N_DATA_BANDS, TARGET_SIZE, MODEL)
+
+    before = time_images(images, model_list, MODEL, NCLASSES, clear_session=True)
+    K.clear_session()
+    after = time_images(images, model_list, MODEL, NCLASSES, clear_session=False)
+
+    print_latencies("clear_session per image (before)", before)
+    print_latencies("persistent session (after)", after)
+    print("Speedup (median): {:.2f}x".format(np.median(before) / np.median(after)))
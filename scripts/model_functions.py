@@ -46,7 +46,7 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 from doodleverse_utils.prediction_imports import seg_file2tensor_3band, standardize, resize  #do_seg
-from doodleverse_utils.imports import label_to_colors, imsave
+from doodleverse_utils.imports import imsave
 # from doodleverse_utils.model_imports import dice_coef_loss
 
 # Import the architectures for following models from doodleverse_utils
@@ -65,6 +65,9 @@ import tensorflow as tf
 from transformers import TFSegformerForSemanticSegmentation
 import tensorflow.keras.backend as K
 
+# local imports
+from model_inference_funcs import label_to_rgb
+
 # ## geospatial imports
 # from osgeo import gdal
 # gdal.SetCacheMax(2**30) # max out the cache
@@ -86,60 +89,64 @@ def get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL):
 
     return image, w, h, bigimage 
 
+# #-----------------------------------
+def get_tta_batch(image, MODEL):
+    """stacks image and its flipud, fliplr and flipud+fliplr copies into a batch of 4,
+    so test-time augmentation needs only one forward pass of each model
+    """
+    # segformer images are channels-first
+    rows, cols = (1, 2) if MODEL=='segformer' else (0, 1)
+    image = np.asarray(image)
+    return np.stack([image, np.flip(image, rows), np.flip(image, cols), np.flip(image, (rows, cols))])
+
+
+def average_tta_batch(est_label, MODEL):
+    """un-flips the 4 predictions of a batch made by get_tta_batch and averages them
+    (soft voting), so the scores stay on the scale of a single prediction (probabilities
+    for the keras models), as in model_inference_funcs. Returns the same shape as the prediction of a single image:
+    (1, NCLASSES, h, w) logits for segformer, squeezed scores for other models
+    """
+    est_label = np.asarray(est_label)
+    rows, cols = (1, 2) if MODEL=='segformer' else (0, 1)
+    est_label = (
+        est_label[0]
+        + np.flip(est_label[1], rows)
+        + np.flip(est_label[2], cols)
+        + np.flip(est_label[3], (rows, cols))
+    ) / 4
+    if MODEL=='segformer':
+        return tf.convert_to_tensor(est_label[np.newaxis])
+    return tf.squeeze(est_label)
+
+
 # #-----------------------------------
 def est_label_multiclass(image,M,MODEL,TESTTIMEAUG,NCLASSES,TARGET_SIZE):
 
     est_label = np.zeros((TARGET_SIZE[0], TARGET_SIZE[1], NCLASSES))
+
+    if TESTTIMEAUG == True:
+        batch = get_tta_batch(image, MODEL)
+    else:
+        batch = tf.expand_dims(image, 0)
     
     for counter, model in enumerate(M):
         # heatmap = make_gradcam_heatmap(tf.expand_dims(image, 0) , model)
         try:
             if MODEL=='segformer':
-                est_label = model(tf.expand_dims(image, 0)).logits
+                est_label = model(batch).logits
             else:
-                est_label = tf.squeeze(model(tf.expand_dims(image, 0)))
+                est_label = model(batch)
         except:
             if MODEL=='segformer':
-                est_label = model(tf.expand_dims(image[:,:,0], 0)).logits
+                est_label = model(batch[...,0]).logits
             else:
-                est_label = tf.squeeze(model(tf.expand_dims(image[:,:,0], 0)))
+                est_label = model(batch[...,0])
 
         if TESTTIMEAUG == True:
-            # return the flipped prediction
-            if MODEL=='segformer':
-                est_label2 = np.flipud(
-                    model(tf.expand_dims(np.flipud(image), 0)).logits
-                    )                
-            else:
-                est_label2 = np.flipud(
-                    tf.squeeze(model(tf.expand_dims(np.flipud(image), 0)))
-                    )
-            if MODEL=='segformer':
-
-                est_label3 = np.fliplr(
-                    model(
-                        tf.expand_dims(np.fliplr(image), 0)).logits
-                        )                
-            else:
-                est_label3 = np.fliplr(
-                    tf.squeeze(model(tf.expand_dims(np.fliplr(image), 0)))
-                )                
-            if MODEL=='segformer':
-                est_label4 = np.flipud(
-                    np.fliplr(
-                        tf.squeeze(model(tf.expand_dims(np.flipud(np.fliplr(image)), 0)).logits))
-                )                
-            else:
-                est_label4 = np.flipud(
-                    np.fliplr(
-                        tf.squeeze(model(
-                            tf.expand_dims(np.flipud(np.fliplr(image)), 0)))
-                            ))
-                
-            # soft voting - sum the softmax scores to return the new TTA estimated softmax scores
-            est_label = est_label + est_label2 + est_label3 + est_label4
-
-        K.clear_session()
+            # return the flipped predictions and average the softmax scores to return the new TTA estimated softmax scores
+            est_label = average_tta_batch(est_label, MODEL)
+        elif MODEL!='segformer':
+            est_label = tf.squeeze(est_label)
 
     # heatmap = resize(heatmap,(w,h), preserve_range=True, clip=True)
     return est_label, counter
@@ -151,59 +158,31 @@ def est_label_binary(image,M,MODEL,TESTTIMEAUG,NCLASSES,TARGET_SIZE,w,h):
     E0 = []
     E1 = []
 
+    if TESTTIMEAUG == True:
+        batch = get_tta_batch(image, MODEL)
+    else:
+        batch = tf.expand_dims(image, 0)
+
     for counter, model in enumerate(M):
         # heatmap = make_gradcam_heatmap(tf.expand_dims(image, 0) , model)
         try:
             if MODEL=='segformer':
-                # est_label = model.predict(tf.expand_dims(image, 0), batch_size=1).logits
-                est_label = model(tf.expand_dims(image, 0)).logits
+                # est_label = model.predict(batch, batch_size=len(batch)).logits
+                est_label = model(batch).logits
             else:
-                est_label = tf.squeeze(model.predict(tf.expand_dims(image, 0), batch_size=1))
+                est_label = model.predict(batch, batch_size=len(batch))
 
         except:
             if MODEL=='segformer':
-                est_label = model.predict(tf.expand_dims(image[:,:,0], 0), batch_size=1).logits
+                est_label = model.predict(batch[...,0], batch_size=len(batch)).logits
             else:
-                est_label = tf.squeeze(model.predict(tf.expand_dims(image[:,:,0], 0), batch_size=1))
+                est_label = model.predict(batch[...,0], batch_size=len(batch))
 
         if TESTTIMEAUG == True:
-            # return the flipped prediction
-            if MODEL=='segformer':
-                est_label2 = np.flipud(
-                    model.predict(tf.expand_dims(np.flipud(image), 0), batch_size=1).logits
-                    )
-            else:
-                est_label2 = np.flipud(
-                    tf.squeeze(model.predict(tf.expand_dims(np.flipud(image), 0), batch_size=1))
-                    )
-
-            if MODEL=='segformer':
-                est_label3 = np.fliplr(
-                    model.predict(
-                        tf.expand_dims(np.fliplr(image), 0), batch_size=1).logits
-                        )
-            else:
-                est_label3 = np.fliplr(
-                    tf.squeeze(model.predict(
-                        tf.expand_dims(np.fliplr(image), 0), batch_size=1))
-                        )
-                
-            if MODEL=='segformer':
-                est_label4 = np.flipud(
-                    np.fliplr(
-                        model.predict(
-                            tf.expand_dims(np.flipud(np.fliplr(image)), 0), batch_size=1).logits)
-                            )
-            else:
-                est_label4 = np.flipud(
-                    np.fliplr(
-                        tf.squeeze(model.predict(
-                            tf.expand_dims(np.flipud(np.fliplr(image)), 0), batch_size=1)))
-                            )
-                
-            # soft voting - sum the softmax scores to return the new TTA estimated softmax scores
-            est_label = est_label + est_label2 + est_label3 + est_label4
-            # del est_label2, est_label3, est_label4
+            # return the flipped predictions and average the softmax scores to return the new TTA estimated softmax scores
+            est_label = average_tta_batch(est_label, MODEL)
+        elif MODEL!='segformer':
+            est_label = tf.squeeze(est_label)
         
         est_label = est_label.numpy().astype('float32')
 
@@ -219,7 +198,6 @@ def est_label_binary(image,M,MODEL,TESTTIMEAUG,NCLASSES,TARGET_SIZE,w,h):
         )
         # del est_label
     # heatmap = resize(heatmap,(w,h), preserve_range=True, clip=True)
-    K.clear_session()
 
     return E0, E1 
 
@@ -347,62 +325,10 @@ def do_seg(
             est_label = est_label.astype('uint8')
 
 
-    class_label_colormap = [
-        "#3366CC",
-        "#DC3912",
-        "#FF9900",
-        "#109618",
-        "#990099",
-        "#0099C6",
-        "#DD4477",
-        "#66AA00",
-        "#B82E2E",
-        "#316395",
-        "#ffe4e1",
-        "#ff7373",
-        "#666666",
-        "#c0c0c0",
-        "#66cdaa",
-        "#afeeee",
-        "#0e2f44",
-        "#420420",
-        "#794044",
-        "#3399ff",
-    ]
-
-    class_label_colormap = class_label_colormap[:NCLASSES]
-
     if WRITE_MODELMETADATA:
         metadatadict["color_segmentation_output"] = segfile
 
-    try:
-        color_label = label_to_colors(
-            est_label,
-            bigimage.numpy()[:, :, 0] == 0,
-            alpha=128,
-            colormap=class_label_colormap,
-            color_class_offset=0,
-            do_alpha=False,
-        )
-    except:
-        try:
-            color_label = label_to_colors(
-                est_label,
-                bigimage[:, :, 0] == 0,
-                alpha=128,
-                colormap=class_label_colormap,
-                color_class_offset=0,
-                do_alpha=False,
-            )
-        except:
-            color_label = label_to_colors(
-                est_label,
-                bigimage == 0,
-                alpha=128,
-                colormap=class_label_colormap,
-                color_class_offset=0,
-                do_alpha=False,
-            )        
+    color_label = label_to_rgb(est_label, bigimage, NCLASSES)
 
     imsave(segfile, (color_label).astype(np.uint8), check_contrast=False)
     
@@ -1001,6 +927,32 @@ def sort_files(sample_direc: str) -> list:
 
 # =========================================================
 
+def init_seg_worker(weights_list: list, MODEL: str, num_threads: int) -> None:
+    """initializer of the worker processes used by compute_segmentation when do_parallel is True.
+    Limits the number of tensorflow threads of the process and loads the models once,
+    so every file segmented by the worker reuses them
+
+    Args:
+        weights_list (list): full path to model weights files(.h5)
+        MODEL (str): model type
+        num_threads (int): number of intra-op threads for this process
+    """
+    global worker_model_list
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    if MODEL != 'segformer':
+        ### mixed precision, as in the parent process
+        from tensorflow.keras import mixed_precision
+        mixed_precision.set_global_policy("mixed_float16")
+    _, worker_model_list, _, _ = get_model(weights_list)
+
+
+def do_seg_worker(f: str, *args, **kwargs) -> str:
+    """runs do_seg on file f with the models loaded by init_seg_worker"""
+    do_seg(f, worker_model_list, *args, **kwargs)
+    return f
+
+
 def compute_segmentation(
     TARGET_SIZE: tuple,
     N_DATA_BANDS: int,
@@ -1010,7 +962,8 @@ def compute_segmentation(
     model_list: list,
     metadatadict: dict,
     do_parallel: bool,
-    profile: str
+    profile: str,
+    num_workers: int = None
 ) -> None:
     """applies models in model_list to directory of imagery in sample_direc.
     imagery will be resized to TARGET_SIZE and should contain number of bands specified by
@@ -1023,6 +976,10 @@ def compute_segmentation(
         sample_direc (str): full path to directory containing imagery to segment
         model_list (list): list of loaded models
         metadatadict (dict): config files, model weight files, and names of each model in model_list
+        do_parallel (bool): segment files in a pool of worker processes, each loading the models
+            from metadatadict["model_weights"] once
+        num_workers (int, optional): number of worker processes if do_parallel.
+            Defaults to one per 4 cpu cores.
     """
     # look for TTA config
     if "TESTTIMEAUG" not in locals():
@@ -1037,11 +994,36 @@ def compute_segmentation(
 
     if do_parallel:
 
-        from joblib import Parallel, delayed
-
-        w = Parallel(n_jobs=-1, verbose=1)(
-            delayed(do_seg(file_to_seg, model_list, metadatadict, MODEL, sample_direc, NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA, OTSU_THRESHOLD, profile))() 
-            for file_to_seg in files_to_segment)
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        import multiprocessing
+
+        num_cpus = os.cpu_count() or 1
+        if num_workers is None:
+            num_workers = max(1, num_cpus // 4)
+        num_workers = max(1, min(num_workers, len(files_to_segment)))
+        # workers x threads per worker = cores on the box
+        num_threads = max(1, num_cpus // num_workers)
+        print("Using {} worker processes with {} threads each".format(num_workers, num_threads))
+
+        # tensorflow is not fork-safe once initialized, so start fresh interpreters
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_seg_worker,
+            initargs=(metadatadict["model_weights"], MODEL, num_threads),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    do_seg_worker, file_to_seg, metadatadict, MODEL, sample_direc, NCLASSES, N_DATA_BANDS,
+                    TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA, OTSU_THRESHOLD, profile=profile
+                ): file_to_seg
+                for file_to_seg in files_to_segment
+            }
+            for future in auto_tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("{} failed: {}".format(futures[future], e))
 
     else:
 
@@ -1060,3 +1042,6 @@ def compute_segmentation(
                 OTSU_THRESHOLD=OTSU_THRESHOLD,
                 profile=profile
             )
+
+    # the keras session is kept for the whole run, release it once at the end
+    K.clear_session()
@@ -3,13 +3,19 @@
 import tensorflow as tf
 
 from transformers import TFSegformerForSemanticSegmentation
+from transformers.modeling_tf_outputs import TFSemanticSegmenterOutput
 import tensorflow.keras.backend as K
 
 import numpy as np
-import os, json, tqdm
+import os, json, tqdm, gc, time, functools
+import queue, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from doodleverse_utils.prediction_imports import seg_file2tensor_3band, standardize, resize, seg_file2tensor_ND, est_label_multiclass, est_label_binary
-from doodleverse_utils.imports import label_to_colors, imsave
+from doodleverse_utils.prediction_imports import seg_file2tensor_3band, standardize, resize, seg_file2tensor_ND
+from doodleverse_utils.imports import imsave
+from skimage.filters import threshold_otsu
+import matplotlib.pyplot as plt
 
 # Import the architectures for following models from doodleverse_utils
 from doodleverse_utils.model_imports import (
@@ -23,6 +29,36 @@ from doodleverse_utils.model_imports import (
 )
 
 
+# version of the "_res.npz" metadata written by write_seg_outputs with lean_metadata (or quantised scores).
+# 1 (no "metadata_version" key) stores "av_prob_stack" and "av_softmax_scores" as two arrays,
+# 2 stores "av_softmax_scores" once and "av_prob_stack" as a reference to it (see load_scores)
+METADATA_VERSION = 2
+
+# colours of the classes in the colour label images
+CLASS_LABEL_COLORMAP = [
+    "#3366CC",
+    "#DC3912",
+    "#FF9900",
+    "#109618",
+    "#990099",
+    "#0099C6",
+    "#DD4477",
+    "#66AA00",
+    "#B82E2E",
+    "#316395",
+    "#ffe4e1",
+    "#ff7373",
+    "#666666",
+    "#c0c0c0",
+    "#66cdaa",
+    "#afeeee",
+    "#0e2f44",
+    "#420420",
+    "#794044",
+    "#3399ff",
+]
+
+
 def sort_files(sample_direc: str) -> list:
     """returns list of sorted filenames in sample_direc
 
@@ -291,6 +327,354 @@ def get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL):
     return image, w, h, bigimage 
 
 
+def get_image_from_array(bigimage, N_DATA_BANDS, TARGET_SIZE, MODEL):
+    """standardizes an image already in memory (e.g. a window of an orthomosaic)
+    the same way get_image does for an image file
+
+    Args:
+        bigimage (np.ndarray): (height, width, bands) uint8 image at native size
+        N_DATA_BANDS (int): number of bands in imagery
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        MODEL (str): model type
+
+    Returns:
+        image, w, h, bigimage: standardized image at TARGET_SIZE, native height and width, and bigimage
+    """
+    if N_DATA_BANDS<=3 and np.ndim(bigimage)==3 and bigimage.shape[-1]>3:
+        bigimage = bigimage[:,:,:3]
+    w, h = bigimage.shape[0], bigimage.shape[1]
+
+    image = resize(bigimage, (TARGET_SIZE[0], TARGET_SIZE[1]), preserve_range=True, clip=True).astype(np.uint8)
+    image = standardize(image).squeeze()
+
+    if MODEL=='segformer':
+        if np.ndim(image)==2:
+            image = np.dstack((image, image, image))
+        image = tf.transpose(image, (2, 0, 1))
+
+    return image, w, h, bigimage
+
+
+# #-----------------------------------
+def get_batch_size(TARGET_SIZE, N_DATA_BANDS, NCLASSES, max_batch_size=16, memory_fraction=0.25):
+    """returns the number of images to push through the models in one forward pass,
+    estimated from the physical memory currently available on this machine
+
+    Args:
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        N_DATA_BANDS (int): number of bands in imagery
+        NCLASSES (int): number of classes used in segmentation model
+        max_batch_size (int, optional): upper limit on the batch size. Defaults to 16.
+        memory_fraction (float, optional): fraction of available memory to spend on a batch. Defaults to 0.25.
+
+    Returns:
+        int: batch size, at least 1
+    """
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        ## os.sysconf is not available on windows
+        try:
+            import psutil
+            available = psutil.virtual_memory().available
+        except ImportError:
+            return 1
+
+    # float32 input and output tensors, plus a generous allowance for the
+    # intermediate activations of a unet/segformer at full TARGET_SIZE
+    bytes_per_image = TARGET_SIZE[0] * TARGET_SIZE[1] * 4 * (N_DATA_BANDS + NCLASSES + 256)
+    batch_size = int(memory_fraction * available // bytes_per_image)
+    return int(np.clip(batch_size, 1, max_batch_size))
+
+
+def get_fused_ensemble(M, MODEL):
+    """wraps all the models of an ensemble into a single model that runs them in one graph
+    and returns their averaged output, so there is one call (and no intermediate numpy arrays)
+    per batch instead of one per model
+
+    Args:
+        M (list): list of loaded models
+        MODEL (str): model type
+
+    Returns:
+        list: a list holding the fused model, or M unchanged if it holds a single model
+        or the models do not share an input shape
+    """
+    if len(M) < 2:
+        return M
+
+    if MODEL=='segformer':
+        @tf.function
+        def average_logits(batch):
+            return tf.add_n([tf.cast(model(batch).logits, tf.float32) for model in M]) / len(M)
+
+        def fused_model(batch):
+            # same output type as a single segformer model
+            return TFSemanticSegmenterOutput(logits=average_logits(batch))
+
+        return [fused_model]
+
+    if len(set(tuple(model.input_shape[1:]) for model in M)) > 1:
+        print("Models in the ensemble have different input shapes and will not be fused")
+        return M
+
+    # called in a tf.function rather than nested as layers of one keras model: models loaded
+    # with load_model often share a name, which a keras model does not allow for its layers.
+    # Outputs are cast to float32, so mixed precision outputs are averaged in float32
+    @tf.function
+    def fused_model(batch, training=False):
+        return tf.add_n([tf.cast(model(batch, training=training), tf.float32) for model in M]) / len(M)
+
+    return [fused_model]
+
+
+def get_traced_model(model, MODEL, TARGET_SIZE, N_DATA_BANDS):
+    """wraps model in a tf.function with a fixed input signature,
+    (None, TARGET_SIZE[0], TARGET_SIZE[1], N_DATA_BANDS) or channels-first for segformer,
+    so the graph is traced once and reused for every batch (of any batch size),
+    instead of running the model eagerly
+
+    Args:
+        model: loaded keras or segformer model (or a fused ensemble from get_fused_ensemble)
+        MODEL (str): model type
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        N_DATA_BANDS (int): number of bands in imagery
+
+    Returns:
+        function: called like the model, returns float32 outputs
+    """
+    if MODEL=='segformer':
+        # get_image stacks single band images into 3 bands for segformer
+        shape = (None, 3 if N_DATA_BANDS==1 else N_DATA_BANDS, TARGET_SIZE[0], TARGET_SIZE[1])
+    else:
+        shape = (None, TARGET_SIZE[0], TARGET_SIZE[1], N_DATA_BANDS)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape, tf.float32)])
+    def traced(batch):
+        if MODEL=='segformer':
+            return tf.cast(model(batch).logits, tf.float32)
+        return tf.cast(model(batch, training=False), tf.float32)
+
+    def traced_model(batch):
+        # single band images are squeezed to (H, W) by get_image
+        batch = tf.reshape(tf.cast(batch, tf.float32), (-1,) + shape[1:])
+        if MODEL=='segformer':
+            return TFSemanticSegmenterOutput(logits=traced(batch))
+        return traced(batch)
+
+    return traced_model
+
+
+def warm_up_models(M, MODEL, TARGET_SIZE, N_DATA_BANDS):
+    """runs a dummy batch through every model in M, so tracing (and any other one-off
+    setup) happens before the first image
+
+    Returns:
+        float: warm-up time (s)
+    """
+    if MODEL=='segformer':
+        dummy = np.zeros((1, 3 if N_DATA_BANDS==1 else N_DATA_BANDS, TARGET_SIZE[0], TARGET_SIZE[1]), dtype=np.float32)
+    else:
+        dummy = np.zeros((1, TARGET_SIZE[0], TARGET_SIZE[1], N_DATA_BANDS), dtype=np.float32)
+
+    start = time.perf_counter()
+    for model in M:
+        model_predict(model, dummy, MODEL)
+    return time.perf_counter() - start
+
+
+def get_spatial_axes(MODEL):
+    """returns the (row, column) axes of a batch of images (or model outputs)
+    segformer models work channels-first, all other models channels-last
+    """
+    if MODEL=='segformer':
+        return (2, 3)
+    return (1, 2)
+
+
+def model_predict(model, batch, MODEL):
+    """runs a single forward pass of model over a batch of standardized images
+
+    Args:
+        model: loaded keras or segformer model
+        batch (np.ndarray): batch of images, (B, H, W, C) or (B, C, H, W) for segformer
+        MODEL (str): model type
+
+    Returns:
+        np.ndarray: float32 scores, (B, H, W, NCLASSES) or (B, NCLASSES, h, w) logits for segformer
+    """
+    try:
+        if MODEL=='segformer':
+            est_label = model(batch).logits
+        else:
+            est_label = model(batch)
+    except:
+        if MODEL=='segformer':
+            #### FIX :3
+            est_label = model(batch[:, :3]).logits
+        else:
+            #### FIX :3
+            est_label = model(batch[..., 0])
+    # est_label cannot be float16 so convert to float32
+    return np.asarray(est_label, dtype=np.float32)
+
+
+def est_label_batch(batch, model, MODEL, TESTTIMEAUG):
+    """returns the scores of one model on a batch of images, with optional test-time augmentation
+
+    Args:
+        batch (np.ndarray): batch of standardized images
+        model: loaded keras or segformer model
+        MODEL (str): model type
+        TESTTIMEAUG (bool): if True, average the scores of the flipped versions of each image
+
+    Returns:
+        np.ndarray: float32 scores in the layout returned by model_predict
+    """
+    if TESTTIMEAUG == True:
+        rows, cols = get_spatial_axes(MODEL)
+        # stack the image, flipud, fliplr and flipud+fliplr views into one batch
+        # so the model runs a single forward pass
+        views = np.concatenate([batch, np.flip(batch, rows), np.flip(batch, cols), np.flip(batch, (rows, cols))])
+        est_label = np.split(model_predict(model, views, MODEL), 4)
+
+        # return the flipped predictions, and soft voting - average the softmax scores
+        # to return the new TTA estimated softmax scores (still probabilities, so they
+        # can be quantised, and the same labels as their sum)
+        est_label = (
+            est_label[0]
+            + np.flip(est_label[1], rows)
+            + np.flip(est_label[2], cols)
+            + np.flip(est_label[3], (rows, cols))
+        ) / 4
+    else:
+        est_label = model_predict(model, batch, MODEL)
+
+    return est_label
+
+
+def softmax(scores, axis=-1):
+    """returns the float32 softmax of scores (e.g. segformer logits) over axis, the class axis"""
+    scores = np.asarray(scores, dtype=np.float32)
+    scores = np.exp(scores - np.max(scores, axis=axis, keepdims=True))
+    return scores / np.sum(scores, axis=axis, keepdims=True)
+
+
+def to_target_layout(est_label, MODEL, NCLASSES, TARGET_SIZE):
+    """returns a batch of scores as (B, TARGET_SIZE[0], TARGET_SIZE[1], NCLASSES)
+    segformer logits are upsampled from 1/4 resolution and moved to channels-last,
+    they are still logits (see to_probabilities)
+    """
+    if MODEL=='segformer':
+        est_label = np.stack([
+            resize(e, (NCLASSES, TARGET_SIZE[0], TARGET_SIZE[1]), preserve_range=True, clip=True)
+            for e in est_label
+        ])
+        est_label = np.transpose(est_label, (0, 2, 3, 1))
+    return est_label
+
+
+def to_probabilities(est_label, MODEL):
+    """returns channels-last scores as probabilities: segformer logits go through a softmax,
+    the scores of the other models already are. Every path averages the logits of the models
+    (and of the TTA views) first, then calls this once
+    """
+    if MODEL=='segformer':
+        est_label = softmax(est_label)
+    return est_label
+
+
+def est_label_multiclass_batch(batch, M, MODEL, TESTTIMEAUG, NCLASSES, TARGET_SIZE):
+    """applies every model in M to a batch of images and sums the scores
+
+    Args:
+        batch (np.ndarray): batch of standardized images
+        M (list): list of loaded models
+        MODEL (str): model type
+        TESTTIMEAUG (bool): use test-time augmentation
+        NCLASSES (int): number of classes used in segmentation model
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+
+    Returns:
+        est_label (np.ndarray): summed scores, (B, TARGET_SIZE[0], TARGET_SIZE[1], NCLASSES),
+            logits for segformer (to_probabilities once averaged)
+        counter (int): index of the last model, i.e. len(M)-1
+    """
+    est_label = np.zeros((len(batch), TARGET_SIZE[0], TARGET_SIZE[1], NCLASSES), dtype=np.float32)
+
+    for counter, model in enumerate(M):
+        est_label += to_target_layout(est_label_batch(batch, model, MODEL, TESTTIMEAUG), MODEL, NCLASSES, TARGET_SIZE)
+
+    return est_label, counter
+
+
+def est_label_ensemble_batch(batch, M, MODEL, TESTTIMEAUG):
+    """returns the average scores of all models in M on a batch of images,
+    at model resolution (no resizing) as float32 channels-last (B, h, w, NCLASSES)
+
+    Args:
+        batch (np.ndarray): batch of standardized images
+        M (list): list of loaded models
+        MODEL (str): model type
+        TESTTIMEAUG (bool): use test-time augmentation
+
+    Returns:
+        np.ndarray: averaged scores, (B, h, w, NCLASSES), probabilities for segformer
+    """
+    est_label = 0
+    for model in M:
+        est_label = est_label + est_label_batch(batch, model, MODEL, TESTTIMEAUG)
+    est_label = est_label / len(M)
+
+    if MODEL=='segformer':
+        est_label = np.transpose(est_label, (0, 2, 3, 1))
+    # averaged logits to probabilities, like the scores of the other models
+    return to_probabilities(est_label, MODEL)
+
+
+def resize_batch(est_labels, sizes):
+    """bilinear float32 resize of a batch of (h, w, NCLASSES) score maps to the
+    native (w, h) of each image, all classes at once, with a single
+    tf.image.resize call when every image has the same size
+
+    Args:
+        est_labels (np.ndarray): scores, (B, h, w, NCLASSES)
+        sizes (list): (w, h) of each image
+
+    Returns:
+        list: (w, h, NCLASSES) float32 scores of each image
+    """
+    if len(set(sizes)) == 1:
+        return list(tf.image.resize(est_labels, sizes[0]).numpy())
+    return [tf.image.resize(est_label, size).numpy() for est_label, size in zip(est_labels, sizes)]
+
+
+def est_label_binary_batch(batch, M, MODEL, TESTTIMEAUG, NCLASSES, TARGET_SIZE, sizes):
+    """applies every model in M to a batch of images, averages their scores (segformer logits,
+    then turned into probabilities) and resizes the average of each class to the native size of each image
+
+    Args:
+        batch (np.ndarray): batch of standardized images
+        M (list): list of loaded models
+        MODEL (str): model type
+        TESTTIMEAUG (bool): use test-time augmentation
+        NCLASSES (int): number of classes used in segmentation model
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        sizes (list): (w, h) of each image in batch
+
+    Returns:
+        E0, E1 (list): for each image, the average class 0 and class 1 scores of the models
+    """
+    est_label = 0
+    for model in M:
+        est_label = est_label + to_target_layout(est_label_batch(batch, model, MODEL, TESTTIMEAUG), MODEL, NCLASSES, TARGET_SIZE)
+    est_label = to_probabilities(est_label / len(M), MODEL)
+
+    E0 = [resize(est_label[k, :, :, 0], (w, h), preserve_range=True, clip=True) for k, (w, h) in enumerate(sizes)]
+    E1 = [resize(est_label[k, :, :, 1], (w, h), preserve_range=True, clip=True) for k, (w, h) in enumerate(sizes)]
+    return E0, E1
+
+
 # # #-----------------------------------
 # def est_label_multiclass(image,M,MODEL,TESTTIMEAUG,NCLASSES,TARGET_SIZE):
 
@@ -435,22 +819,30 @@ def get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL):
 
 #     return E0, E1 
 
+# #-----------------------------------
+def end_segmentation_session():
+    """teardown hook, called once at the end of compute_segmentation.
+    The keras session and the functions traced for the models are kept for the
+    whole run (clearing them for every image forces a retrace on the next one),
+    and released here
+    """
+    K.clear_session()
+    gc.collect()
+
+
 # =========================================================
-def do_seg(
-    f, M, metadatadict, MODEL, sample_direc, 
-    NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA,
-    OTSU_THRESHOLD,
-    out_dir_name='out',
-    profile='minimal'
-):
-    
-    if profile=='meta':
-        WRITE_MODELMETADATA = True
-    if profile=='full':
-        WRITE_MODELMETADATA = True
+def get_segfile(f, sample_direc, out_dir_name='out'):
+    """returns the full path to the colour label image ("_predseg.png") for input file f,
+    inside a subdirectory of sample_direc named out_dir_name (created if needed)
 
-    # Mc = compile_models(M, MODEL)
+    Args:
+        f (str): full path to input image
+        sample_direc (str): full path to directory containing imagery to segment
+        out_dir_name (str, optional): name of the output directory. Defaults to 'out'.
 
+    Returns:
+        str: full path to the colour label image
+    """
     if f.endswith("jpg"):
         segfile = f.replace(".jpg", "_predseg.png")
     elif f.endswith("png"):
@@ -460,9 +852,6 @@ def do_seg(
     elif f.endswith("npz"):  # in f:
         segfile = f.replace(".npz", "_predseg.png")
 
-    if WRITE_MODELMETADATA:
-        metadatadict["input_file"] = f
-        
     # directory to hold the outputs of the models is named 'out' by default
     # create a directory to hold the outputs of the models, by default name it 'out' or the model name if it exists in metadatadict
     out_dir_path = os.path.normpath(sample_direc + os.sep + out_dir_name)
@@ -473,150 +862,322 @@ def do_seg(
     segfile = segfile.replace(
         os.path.normpath(sample_direc), os.path.normpath(sample_direc + os.sep + out_dir_name)
     )
+    return segfile
 
-    if WRITE_MODELMETADATA:
-        metadatadict["nclasses"] = NCLASSES
-        metadatadict["n_data_bands"] = N_DATA_BANDS
 
-    if NCLASSES == 2:
+def get_output_size(MODEL, TARGET_SIZE):
+    """returns the (w, h) of the scores of a model for images of TARGET_SIZE:
+    segformer logits are at 1/4 of the input resolution, other models at TARGET_SIZE
+    """
+    if MODEL=='segformer':
+        return TARGET_SIZE[0] // 4, TARGET_SIZE[1] // 4
+    return TARGET_SIZE[0], TARGET_SIZE[1]
 
-        image, w, h, bigimage = get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL)
 
-        if np.std(image)==0:
+def predict_batch(images, sizes, M, MODEL, NCLASSES, TARGET_SIZE, TESTTIMEAUG, OTSU_THRESHOLD, fast_resize=False, upsample=True):
+    """segments a batch of standardized images with every model in M
 
-            print("Image {} is empty".format(f))
-            e0 = np.zeros((w,h))
-            e1 = np.zeros((w,h))
+    Empty (constant) images are not passed to the models, they get all-zero scores
 
+    Args:
+        images (list): standardized images, as returned by get_image
+        sizes (list): (w, h) of each image
+        M (list): list of loaded models
+        MODEL (str): model type
+        NCLASSES (int): number of classes used in segmentation model
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        TESTTIMEAUG (bool): use test-time augmentation
+        OTSU_THRESHOLD (bool): threshold binary probabilities with Otsu's method instead of 0.5
+        fast_resize (bool, optional): average the models at model resolution in float32
+            (est_label_ensemble_batch) and resize all classes to the native size of each image
+            in a single step (resize_batch), instead of resizing with skimage per model (NCLASSES == 2)
+            or via TARGET_SIZE (segformer). Defaults to False.
+        upsample (bool, optional): if False, keep the scores and label at model resolution
+            (implies fast_resize). Empty images then get outputs of the model resolution too
+            (get_output_size). Defaults to True.
+
+    Returns:
+        list: one dict per image with keys "av_prob_stack", "av_softmax_scores", "grey_label"
+        (and "otsu_threshold" if NCLASSES == 2). The scores are probabilities for every model,
+        segformer logits are averaged over the models and TTA views, then go through a single softmax (to_probabilities)
+    """
+    if not upsample:
+        fast_resize = True
+
+    is_empty = [np.std(image)==0 for image in images]
+    full = [k for k in range(len(images)) if not is_empty[k]]
+    # position of each non-empty image in the model batch
+    position = {k: i for i, k in enumerate(full)}
+
+    if len(full) > 0:
+        batch = np.stack([np.asarray(images[k]) for k in full])
+        if fast_resize:
+            # float32 accumulator at model resolution, one resize per image (or none)
+            est_labels = est_label_ensemble_batch(batch, M, MODEL, TESTTIMEAUG)
+            if upsample:
+                est_labels = resize_batch(est_labels, [sizes[k] for k in full])
+        elif NCLASSES == 2:
+            E0, E1 = est_label_binary_batch(batch, M, MODEL, TESTTIMEAUG, NCLASSES, TARGET_SIZE, [sizes[k] for k in full])
         else:
+            est_labels, counter = est_label_multiclass_batch(batch, M, MODEL, TESTTIMEAUG, NCLASSES, TARGET_SIZE)
+            est_labels = to_probabilities(est_labels / (counter + 1), MODEL)
+
+    if not upsample:
+        # every output of the batch at model resolution, empty images included
+        output_size = est_labels.shape[1:3] if len(full) > 0 else get_output_size(MODEL, TARGET_SIZE)
+
+    results = []
+    for k, (w, h) in enumerate(sizes):
+        result = {}
+        if not upsample:
+            w, h = output_size
+
+        if NCLASSES == 2:
+
+            if is_empty[k]:
+                e0 = np.zeros((w,h))
+                e1 = np.zeros((w,h))
+            elif fast_resize:
+                e0 = est_labels[position[k]][:, :, 0]
+                e1 = est_labels[position[k]][:, :, 1]
+            else:
+                e0 = E0[position[k]]
+                e1 = E1[position[k]]
 
-            E0, E1 = est_label_binary(image,M,MODEL,TESTTIMEAUG,NCLASSES,TARGET_SIZE,w,h)
+            est_label = (e1 + (1 - e0)) / 2
+            result["av_prob_stack"] = est_label
+            result["av_softmax_scores"] = np.dstack((e0,e1))
 
-            e0 = np.average(np.dstack(E0), axis=-1)  
+            if OTSU_THRESHOLD:
+                thres = threshold_otsu(est_label)
+            else:
+                thres = 0.5
+            result["otsu_threshold"] = thres
+            result["grey_label"] = (est_label > thres).astype("uint8")
 
-            # del E0
+        else:  ###NCLASSES>2
 
-            e1 = np.average(np.dstack(E1), axis=-1) 
-            # del E1
+            if is_empty[k]:
+                est_label = np.zeros((w,h))
+            elif fast_resize:
+                est_label = est_labels[position[k]]
+            else:
+                est_label = resize(est_labels[position[k]], (w, h))
 
-        est_label = (e1 + (1 - e0)) / 2
+            # same array, not a copy
+            result["av_prob_stack"] = est_label
+            result["av_softmax_scores"] = est_label
 
-        if WRITE_MODELMETADATA:
-            metadatadict["av_prob_stack"] = est_label
+            if is_empty[k]:
+                result["grey_label"] = est_label.astype('uint8')
+            else:
+                result["grey_label"] = np.argmax(est_label, -1)
 
-        softmax_scores = np.dstack((e0,e1))
-        # del e0, e1
+        results.append(result)
 
-        if WRITE_MODELMETADATA:
-            metadatadict["av_softmax_scores"] = softmax_scores
+    return results
 
-        if OTSU_THRESHOLD:
-            thres = threshold_otsu(est_label)
-            # print("Class threshold: %f" % (thres))
-            est_label = (est_label > thres).astype("uint8")
-            if WRITE_MODELMETADATA:
-                metadatadict["otsu_threshold"] = thres
 
-        else:
-            est_label = (est_label > 0.5).astype("uint8")
-            if WRITE_MODELMETADATA:
-                metadatadict["otsu_threshold"] = 0.5            
+def quantise_scores(scores, prob_dtype="float32"):
+    """returns scores (probabilities, 0-1) stored as prob_dtype, and the scale that dequantises them
 
-    else:  ###NCLASSES>2
+    Args:
+        scores (np.ndarray): probabilities, as returned by predict_batch
+        prob_dtype (str, optional): "float32" (unchanged), "float16", or "uint8" (0-255). Defaults to "float32".
 
-        image, w, h, bigimage = get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL)
+    Returns:
+        tuple: stored scores, and prob_scale such that scores = stored * prob_scale
+    """
+    if prob_dtype == "uint8":
+        # clipping anything else (e.g. logits) to 0-1 would change which class scores highest
+        if np.size(scores) > 0 and (np.min(scores) < -1e-3 or np.max(scores) > 1 + 1e-3):
+            raise ValueError("uint8 scores must be probabilities (0-1), got {:.3f} to {:.3f}".format(np.min(scores), np.max(scores)))
+        return np.round(np.clip(scores, 0, 1) * 255).astype(np.uint8), 1 / 255
+    if prob_dtype == "float16":
+        return np.asarray(scores, dtype=np.float16), 1.0
+    return scores, 1.0
+
+
+def load_scores(data, key="av_softmax_scores"):
+    """returns the float32 scores stored under key in a "_res.npz" file, dequantised (see quantise_scores).
+    Version 2 files (METADATA_VERSION) store the scores once, as "av_softmax_scores", and "av_prob_stack"
+    refers to them. It is computed from them as predict_batch does: the same array for NCLASSES > 2,
+    (e1 + (1 - e0)) / 2 for binary models
 
-        if np.std(image)==0:
+    Args:
+        data: opened "_res.npz" file (np.load) or dict
+        key (str, optional): "av_softmax_scores" or "av_prob_stack". Defaults to "av_softmax_scores".
 
-            print("Image {} is empty".format(f))
-            est_label = np.zeros((w,h))
+    Returns:
+        np.ndarray: float32 scores
+    """
+    if key in data and np.asarray(data[key]).dtype.kind != "U":
+        scores = np.asarray(data[key], dtype=np.float32)
+        if key == "av_softmax_scores" and "prob_scale" in data:
+            scores *= np.float32(data["prob_scale"])
+        return scores
 
-        else:
-                
-            est_label, counter = est_label_multiclass(image,M,MODEL,TESTTIMEAUG,NCLASSES,TARGET_SIZE)
+    # av_prob_stack of a version 2 file
+    scores = load_scores(data, "av_softmax_scores")
+    if int(data["nclasses"]) == 2:
+        return (scores[:, :, 1] + (1 - scores[:, :, 0])) / 2
+    return scores
 
-            est_label /= counter + 1
-            # est_label cannot be float16 so convert to float32
-            est_label = est_label.numpy().astype('float32')
 
-            if MODEL=='segformer':
-                est_label = resize(est_label, (1, NCLASSES, TARGET_SIZE[0],TARGET_SIZE[1]), preserve_range=True, clip=True).squeeze()
-                est_label = np.transpose(est_label, (1,2,0))
-                est_label = resize(est_label, (w, h))
-            else:
-                est_label = resize(est_label, (w, h))
+@functools.lru_cache(maxsize=None)
+def get_color_lut(NCLASSES):
+    """returns the (NCLASSES, 3) uint8 RGB colours of the classes, from CLASS_LABEL_COLORMAP.
+    Cached, so the colours are parsed once per class count rather than once per image
 
+    Args:
+        NCLASSES (int): number of classes used in segmentation model
 
-        if WRITE_MODELMETADATA:
-            metadatadict["av_prob_stack"] = est_label
+    Returns:
+        np.ndarray: read-only lookup table, row k is the colour of class k
+    """
+    colormap = CLASS_LABEL_COLORMAP[:NCLASSES]
+    lut = np.array([[int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16)] for c in colormap], dtype=np.uint8)
+    # with more classes than colours, class k gets colour k % len(colormap), as label_to_colors
+    # (doodleverse_utils) colours them, so colours repeat from class 20 on
+    lut = lut[np.arange(NCLASSES) % len(colormap)]
+    lut.setflags(write=False)
+    return lut
 
-        softmax_scores = est_label.copy() #np.dstack((e0,e1))
 
-        if WRITE_MODELMETADATA:
-            metadatadict["av_softmax_scores"] = softmax_scores
+def label_to_rgb(est_label, bigimage, NCLASSES):
+    """returns the colour label image of est_label, with one lookup table gather (get_color_lut);
+    pixels where the first band of bigimage is 0 (nodata) are black
+
+    Args:
+        est_label (np.ndarray): (height, width) label, 0 to NCLASSES-1
+        bigimage: input image, same height and width as est_label
+        NCLASSES (int): number of classes used in segmentation model
+
+    Returns:
+        np.ndarray: (height, width, 3) uint8 colour label image
+    """
+    color_label = get_color_lut(NCLASSES)[np.asarray(est_label, dtype=np.intp)]
+    bigimage = np.asarray(bigimage)
+    color_label[(bigimage[:, :, 0] if bigimage.ndim == 3 else bigimage) == 0] = 0
+    return color_label
 
-        if np.std(image)>0:
-            est_label = np.argmax(softmax_scores, -1)
+
+def get_color_table(colormap):
+    """returns a gdal color table mapping label k+1 to the hex colour colormap[k] (0 is nodata, black)"""
+    # gdal is only needed for GeoTIFF outputs, it is not in the zoo environment
+    from osgeo import gdal
+
+    color_table = gdal.ColorTable()
+    color_table.SetColorEntry(0, (0, 0, 0, 0))
+    for k, c in enumerate(colormap):
+        color_table.SetColorEntry(k+1, (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16), 255))
+    return color_table
+
+
+def write_label_geotiff(labelfile, est_label, geotransform, projection, NCLASSES):
+    """writes a label image as a compressed uint8 GeoTIFF, 1 + class (0 = nodata),
+    with the colours of CLASS_LABEL_COLORMAP as its color table
+
+    Args:
+        labelfile (str): full path to the output GeoTIFF
+        est_label (np.ndarray): (height, width) label, 0 to NCLASSES-1
+        geotransform (tuple): gdal geotransform of the label
+        projection (str): projection of the label (WKT)
+        NCLASSES (int): number of classes used in segmentation model
+    """
+    from osgeo import gdal
+
+    height, width = est_label.shape[:2]
+    ds = gdal.GetDriverByName("GTiff").Create(labelfile, width, height, 1, gdal.GDT_Byte, options=["TILED=YES", "COMPRESS=LZW"])
+    ds.SetGeoTransform(tuple(geotransform))
+    ds.SetProjection(str(projection))
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.SetRasterColorTable(get_color_table(CLASS_LABEL_COLORMAP[:NCLASSES]))
+    band.WriteArray((1 + np.asarray(est_label)).astype(np.uint8))
+    ds = None # close and save ds
+
+
+def write_seg_outputs(
+    f, segfile, result, bigimage, metadatadict,
+    NCLASSES, N_DATA_BANDS, WRITE_MODELMETADATA,
+    profile='minimal',
+    write_label_tif=False,
+    prob_dtype='float32',
+    lean_metadata=False
+):
+    """writes the colour label image for input file f, and depending on profile
+    the "_res.npz" model metadata and overlay figures
+
+    Args:
+        f (str): full path to input image
+        segfile (str): full path to the colour label image, from get_segfile
+        result (dict): scores and label of the image, from predict_batch
+        bigimage: input image at native size
+        metadatadict (dict): config files, model weight files, and names of each model
+        NCLASSES (int): number of classes used in segmentation model
+        N_DATA_BANDS (int): number of bands in imagery
+        WRITE_MODELMETADATA (bool): write the "_res.npz" file
+        profile (str, optional): 'minimal', 'meta' or 'full'. Defaults to 'minimal'.
+        write_label_tif (bool, optional): also write the label as a georeferenced uint8 GeoTIFF ("_label.tif",
+            see write_label_geotiff), georeferenced by the "geotransform" and "projection" in metadatadict
+            (images segmented in memory) or else by those of f. Defaults to False.
+        prob_dtype (str, optional): storage of the scores in the "_res.npz" file (see quantise_scores).
+            With "float16" or "uint8" the scores are stored once (see lean_metadata), with their "prob_scale".
+            Defaults to 'float32'.
+        lean_metadata (bool, optional): write version 2 metadata (METADATA_VERSION), with the scores stored once.
+            Read the scores of either version with load_scores. Defaults to False.
+    """
+    if profile=='meta':
+        WRITE_MODELMETADATA = True
+    if profile=='full':
+        WRITE_MODELMETADATA = True
+
+    est_label = result["grey_label"]
+    softmax_scores = result["av_softmax_scores"]
+
+    if WRITE_MODELMETADATA:
+        # per-file copy, outputs of several files may be written at once
+        metadatadict = dict(metadatadict)
+        metadatadict["input_file"] = f
+        metadatadict["nclasses"] = NCLASSES
+        metadatadict["n_data_bands"] = N_DATA_BANDS
+        if lean_metadata or prob_dtype != 'float32':
+            metadatadict["metadata_version"] = METADATA_VERSION
+            metadatadict["av_softmax_scores"], metadatadict["prob_scale"] = quantise_scores(softmax_scores, prob_dtype)
+            metadatadict["prob_dtype"] = prob_dtype
+            metadatadict["av_prob_stack"] = "av_softmax_scores"
         else:
-            est_label = est_label.astype('uint8')
-
-
-    class_label_colormap = [
-        "#3366CC",
-        "#DC3912",
-        "#FF9900",
-        "#109618",
-        "#990099",
-        "#0099C6",
-        "#DD4477",
-        "#66AA00",
-        "#B82E2E",
-        "#316395",
-        "#ffe4e1",
-        "#ff7373",
-        "#666666",
-        "#c0c0c0",
-        "#66cdaa",
-        "#afeeee",
-        "#0e2f44",
-        "#420420",
-        "#794044",
-        "#3399ff",
-    ]
-
-    class_label_colormap = class_label_colormap[:NCLASSES]
+            metadatadict["av_prob_stack"] = result["av_prob_stack"]
+            metadatadict["av_softmax_scores"] = softmax_scores
+        if "otsu_threshold" in result:
+            metadatadict["otsu_threshold"] = result["otsu_threshold"]
 
     if WRITE_MODELMETADATA:
         metadatadict["color_segmentation_output"] = segfile
 
-    try:
-        color_label = label_to_colors(
-            est_label,
-            bigimage.numpy()[:, :, 0] == 0,
-            alpha=128,
-            colormap=class_label_colormap,
-            color_class_offset=0,
-            do_alpha=False,
+    if write_label_tif:
+        if "geotransform" in metadatadict:
+            geotransform, projection = metadatadict["geotransform"], metadatadict.get("projection", "")
+        else:
+            from osgeo import gdal
+            ds = gdal.Open(f)
+            geotransform, projection = ds.GetGeoTransform(), ds.GetProjection()
+            ds = None # close ds
+        # pixel size of a label kept at model resolution
+        scale = np.asarray(bigimage).shape[0] / est_label.shape[0], np.asarray(bigimage).shape[1] / est_label.shape[1]
+        geotransform = (
+            geotransform[0], geotransform[1] * scale[1], geotransform[2] * scale[0],
+            geotransform[3], geotransform[4] * scale[1], geotransform[5] * scale[0],
         )
-    except:
-        try:
-            color_label = label_to_colors(
-                est_label,
-                bigimage[:, :, 0] == 0,
-                alpha=128,
-                colormap=class_label_colormap,
-                color_class_offset=0,
-                do_alpha=False,
-            )
-        except:
-            color_label = label_to_colors(
-                est_label,
-                bigimage == 0,
-                alpha=128,
-                colormap=class_label_colormap,
-                color_class_offset=0,
-                do_alpha=False,
-            )        
+        write_label_geotiff(segfile.replace("_predseg.png", "_label.tif"), est_label, geotransform, projection, NCLASSES)
+
+    if np.asarray(bigimage).shape[:2] != est_label.shape[:2]:
+        # label kept at model resolution (predict_batch with upsample=False)
+        bigimage = np.asarray(bigimage)
+        bigimage = resize(bigimage, est_label.shape[:2] + bigimage.shape[2:], order=0, preserve_range=True, anti_aliasing=False)
+
+    color_label = label_to_rgb(est_label, bigimage, NCLASSES)
 
     imsave(segfile, (color_label).astype(np.uint8), check_contrast=False)
     
@@ -681,6 +1242,244 @@ def do_seg(
             plt.close("all")
 
 
+def decode_batch(files, N_DATA_BANDS, TARGET_SIZE, MODEL, executor=None):
+    """reads and standardizes a list of image files with get_image
+
+    Args:
+        files (list): full paths to images
+        N_DATA_BANDS (int): number of bands in imagery
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        MODEL (str): model type
+        executor (concurrent.futures.Executor, optional): decode the files in parallel on this executor. Defaults to None.
+
+    Returns:
+        images, sizes, bigimages (list): standardized images, their native (w, h), and the images at native size
+    """
+    if executor is None:
+        decoded = [get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL) for f in files]
+    else:
+        decoded = list(executor.map(lambda f: get_image(f,N_DATA_BANDS,TARGET_SIZE,MODEL), files))
+
+    images, sizes, bigimages = [], [], []
+    for f, (image, w, h, bigimage) in zip(files, decoded):
+        if np.std(image)==0:
+            print("Image {} is empty".format(f))
+        images.append(image)
+        sizes.append((int(w), int(h)))
+        bigimages.append(bigimage)
+    return images, sizes, bigimages
+
+
+def decode_array_batch(items, sample_direc, N_DATA_BANDS, TARGET_SIZE, MODEL):
+    """standardizes a list of in-memory images with get_image_from_array
+
+    Args:
+        items (list): dicts with keys "name" (output file name root) and "image" ((height, width, bands) array),
+            and optionally "geotransform" and "projection" (e.g. from orthomosaic_funcs.iter_tiles)
+        sample_direc (str): full path to the directory the outputs are written under
+        N_DATA_BANDS (int): number of bands in imagery
+        TARGET_SIZE (tuple): size the imagery is resized to before inference
+        MODEL (str): model type
+
+    Returns:
+        files, images, sizes, bigimages, georefs (list): a (virtual) tif path in sample_direc named after each item,
+        standardized images, their native (w, h), the images at native size, and the georeferencing of each item
+    """
+    files, images, sizes, bigimages, georefs = [], [], [], [], []
+    for item in items:
+        image, w, h, bigimage = get_image_from_array(np.asarray(item["image"]), N_DATA_BANDS, TARGET_SIZE, MODEL)
+        f = os.path.join(sample_direc, item["name"] + ".tif")
+        if np.std(image)==0:
+            print("Image {} is empty".format(item["name"]))
+        files.append(f)
+        images.append(image)
+        sizes.append((int(w), int(h)))
+        bigimages.append(bigimage)
+        georefs.append({k: item[k] for k in ("geotransform", "projection") if k in item})
+    return files, images, sizes, bigimages, georefs
+
+
+def iter_array_batches(items, sample_direc, N_DATA_BANDS, TARGET_SIZE, MODEL, batch_size):
+    """generator of decoded batches (decode_array_batch) of an iterable of in-memory images
+
+    Yields:
+        tuple: (batch_files, images, sizes, bigimages, georefs)
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield decode_array_batch(batch, sample_direc, N_DATA_BANDS, TARGET_SIZE, MODEL)
+            batch = []
+    if len(batch) > 0:
+        yield decode_array_batch(batch, sample_direc, N_DATA_BANDS, TARGET_SIZE, MODEL)
+
+
+def iter_file_batches(files, N_DATA_BANDS, TARGET_SIZE, MODEL, batch_size, num_workers=1):
+    """generator of decoded batches (decode_batch) of files
+
+    Yields:
+        tuple: (batch_files, images, sizes, bigimages)
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start in range(0, len(files), batch_size):
+            batch_files = files[start:start+batch_size]
+            yield (batch_files,) + decode_batch(batch_files, N_DATA_BANDS, TARGET_SIZE, MODEL, executor)
+
+
+def prefetch_generator(batches, prefetch=2):
+    """runs a generator of batches in a background thread, up to prefetch batches ahead,
+    while the caller runs inference on the current one
+
+    Args:
+        batches (iterable): batches, e.g. from iter_file_batches or iter_array_batches
+        prefetch (int, optional): maximum number of batches held in memory. Defaults to 2.
+
+    Yields:
+        the items of batches
+    """
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for batch in batches:
+                if stop.is_set():
+                    return
+                buffer.put(batch)
+        except BaseException as e:
+            # hand the error to the consumer so it is raised in the main thread
+            buffer.put(e)
+        else:
+            buffer.put(None)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # unblock the producer if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def wait_for_writes(pending, max_pending=0):
+    """waits for the oldest output writes in pending until no more than max_pending remain,
+    reporting any file whose outputs could not be written
+
+    Args:
+        pending (collections.deque): (file, future) of each submitted write, oldest first
+        max_pending (int, optional): number of writes that may stay in flight. Defaults to 0.
+
+    Returns:
+        list: files whose outputs failed to write
+    """
+    failed = []
+    while len(pending) > max_pending:
+        f, future = pending.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            print("Writing outputs for {} failed: {}".format(f, e))
+            failed.append(f)
+    return failed
+
+
+def segment_decoded_batch(
+    files, images, sizes, bigimages, M, metadatadict, MODEL, sample_direc, 
+    NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA,
+    OTSU_THRESHOLD,
+    out_dir_name='out',
+    profile='minimal',
+    write_label_tif=False,
+    prob_dtype='float32',
+    lean_metadata=False,
+    fast_resize=False,
+    upsample=True
+):
+    """runs the models in M on a batch of already decoded images (from decode_batch)
+    and writes the outputs of each file. The options are those of compute_segmentation
+    """
+    results = predict_batch(images, sizes, M, MODEL, NCLASSES, TARGET_SIZE, TESTTIMEAUG, OTSU_THRESHOLD, fast_resize=fast_resize, upsample=upsample)
+
+    for f, result, bigimage in zip(files, results, bigimages):
+        write_seg_outputs(
+            f, get_segfile(f, sample_direc, out_dir_name), result, bigimage, metadatadict,
+            NCLASSES, N_DATA_BANDS, WRITE_MODELMETADATA,
+            profile=profile,
+            write_label_tif=write_label_tif,
+            prob_dtype=prob_dtype,
+            lean_metadata=lean_metadata
+        )
+
+
+def do_seg_batch(
+    files, M, metadatadict, MODEL, sample_direc, 
+    NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA,
+    OTSU_THRESHOLD,
+    out_dir_name='out',
+    profile='minimal',
+    write_label_tif=False,
+    prob_dtype='float32',
+    lean_metadata=False,
+    fast_resize=False,
+    upsample=True
+):
+    """segments a list of image files with a single forward pass of each model in M,
+    and writes the outputs of each file exactly as do_seg would
+    """
+    images, sizes, bigimages = decode_batch(files, N_DATA_BANDS, TARGET_SIZE, MODEL)
+
+    segment_decoded_batch(
+        files, images, sizes, bigimages, M, metadatadict, MODEL, sample_direc,
+        NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA,
+        OTSU_THRESHOLD,
+        out_dir_name=out_dir_name,
+        profile=profile,
+        write_label_tif=write_label_tif,
+        prob_dtype=prob_dtype,
+        lean_metadata=lean_metadata,
+        fast_resize=fast_resize,
+        upsample=upsample
+    )
+
+
+def do_seg(
+    f, M, metadatadict, MODEL, sample_direc, 
+    NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA,
+    OTSU_THRESHOLD,
+    out_dir_name='out',
+    profile='minimal',
+    write_label_tif=False,
+    prob_dtype='float32',
+    lean_metadata=False,
+    fast_resize=False,
+    upsample=True
+):
+    do_seg_batch(
+        [f], M, metadatadict, MODEL, sample_direc,
+        NCLASSES, N_DATA_BANDS, TARGET_SIZE, TESTTIMEAUG, WRITE_MODELMETADATA,
+        OTSU_THRESHOLD,
+        out_dir_name=out_dir_name,
+        profile=profile,
+        write_label_tif=write_label_tif,
+        prob_dtype=prob_dtype,
+        lean_metadata=lean_metadata,
+        fast_resize=fast_resize,
+        upsample=upsample
+    )
+
 
 def compute_segmentation(
     TARGET_SIZE: tuple,
@@ -691,8 +1490,20 @@ def compute_segmentation(
     model_list: list,
     metadatadict: dict,
     profile: str,
-    out_dir_name: str
-) -> None:
+    out_dir_name: str,
+    batch_size: int = 1,
+    prefetch: int = 2,
+    num_writers: int = 2,
+    fuse_ensemble: bool = False,
+    trace_models: bool = False,
+    fast_resize: bool = False,
+    upsample: bool = True,
+    files_to_skip: list = None,
+    images=None,
+    write_label_tif: bool = False,
+    prob_dtype: str = 'float32',
+    lean_metadata: bool = False
+) -> dict:
     """applies models in model_list to directory of imagery in sample_direc.
     imagery will be resized to TARGET_SIZE and should contain number of bands specified by
     N_DATA_BANDS. The outputted segmentation will contain number of classes corresponding to NCLASSES.
@@ -704,6 +1515,40 @@ def compute_segmentation(
         sample_direc (str): full path to directory containing imagery to segment
         model_list (list): list of loaded models
         metadatadict (dict): config files, model weight files, and names of each model in model_list
+        batch_size (int, optional): number of images per forward pass of each model.
+            None picks a batch size from the available memory. Defaults to 1.
+        prefetch (int, optional): number of batches to decode in the background while the models run.
+            0 decodes each batch just before it is segmented. Defaults to 2.
+        num_writers (int, optional): number of background threads writing the output files,
+            so the models do not wait on png encoding and npz compression.
+            0 writes the outputs of each batch before moving on. Always 0 with profile 'full',
+            whose overlay figures are drawn with pyplot on the main thread. Defaults to 2.
+        fuse_ensemble (bool, optional): run all the models of an ensemble as a single model
+            averaging their outputs (see get_fused_ensemble). Defaults to False.
+        trace_models (bool, optional): run the models through a tf.function with a fixed input
+            signature, traced once with a dummy batch before the first image (see get_traced_model).
+            Defaults to False.
+        fast_resize (bool, optional): keep the ensemble scores at model resolution in float32
+            and upsample them once, straight to the native size of each image (see predict_batch).
+            Defaults to False.
+        upsample (bool, optional): if False, write labels and scores at model resolution,
+            for callers that only need a low-resolution label. Defaults to True.
+        files_to_skip (list, optional): files in sample_direc not to segment, e.g. empty
+            orthomosaic tiles. Defaults to None.
+        images (iterable, optional): segment these in-memory images instead of the files in sample_direc,
+            e.g. a generator of orthomosaic tiles (orthomosaic_funcs.iter_tiles). Each item is a dict with
+            "name" (outputs are named as for a file sample_direc/name.tif) and "image" ((height, width, bands) array),
+            and optionally "geotransform" and "projection", written to the "_res.npz" file. Defaults to None.
+        write_label_tif (bool, optional): also write each label as a georeferenced uint8 GeoTIFF
+            in the same pass as the colour label (see write_seg_outputs). Defaults to False.
+        prob_dtype (str, optional): 'float32', 'float16' or 'uint8' storage of the scores in the "_res.npz" files,
+            see write_seg_outputs. Defaults to 'float32'.
+        lean_metadata (bool, optional): write version 2 "_res.npz" metadata, with the scores stored once
+            (see write_seg_outputs). Defaults to False.
+
+    Returns:
+        dict: timing metrics of the run; "warmup_seconds" (0 unless trace_models),
+        "num_images", "inference_seconds" and "seconds_per_image" (steady-state model latency)
     """
     # look for TTA config
     if "TESTTIMEAUG" not in locals():
@@ -711,24 +1556,82 @@ def compute_segmentation(
     WRITE_MODELMETADATA = False
     OTSU_THRESHOLD=False
 
-    # Read in the image filenames as either .npz,.jpg, or .png
-    files_to_segment = sort_files(sample_direc)
+    if batch_size is None:
+        batch_size = get_batch_size(TARGET_SIZE, N_DATA_BANDS, NCLASSES)
+        print("Using batch size : {}".format(batch_size))
+
+    if fuse_ensemble:
+        model_list = get_fused_ensemble(model_list, MODEL)
+
+    metrics = {"warmup_seconds": 0.0, "num_images": 0, "inference_seconds": 0.0}
+    if trace_models:
+        model_list = [get_traced_model(model, MODEL, TARGET_SIZE, N_DATA_BANDS) for model in model_list]
+        metrics["warmup_seconds"] = warm_up_models(model_list, MODEL, TARGET_SIZE, N_DATA_BANDS)
+        print("Model warm-up : {:.2f} s".format(metrics["warmup_seconds"]))
+
     sample_direc=os.path.abspath(sample_direc)
-    # Compute the segmentation for each of the files
-
-    for file_to_seg in tqdm.auto.tqdm(files_to_segment):
-        do_seg(
-            file_to_seg,
-            model_list,
-            metadatadict,
-            MODEL,
-            sample_direc=sample_direc,
-            NCLASSES=NCLASSES,
-            N_DATA_BANDS=N_DATA_BANDS,
-            TARGET_SIZE=TARGET_SIZE,
-            TESTTIMEAUG=TESTTIMEAUG,
-            WRITE_MODELMETADATA=WRITE_MODELMETADATA,
-            OTSU_THRESHOLD=OTSU_THRESHOLD,
-            profile=profile,
-            out_dir_name=out_dir_name
+    if images is not None:
+        # in-memory images, no files to read
+        num_batches = -(-len(images) // batch_size) if hasattr(images, "__len__") else None
+        batches = iter_array_batches(images, sample_direc, N_DATA_BANDS, TARGET_SIZE, MODEL, batch_size)
+    else:
+        # Read in the image filenames as either .npz,.jpg, or .png
+        files_to_segment = sort_files(sample_direc)
+        if files_to_skip:
+            num_files = len(files_to_segment)
+            files_to_skip = set(os.path.normpath(f) for f in files_to_skip)
+            files_to_segment = [f for f in files_to_segment if os.path.normpath(f) not in files_to_skip]
+            print("Skipping {} files".format(num_files - len(files_to_segment)))
+        # Compute the segmentation for each batch of files
+        num_batches = -(-len(files_to_segment) // batch_size)
+        batches = (
+            batch + ([{}] * len(batch[0]),)
+            for batch in iter_file_batches(files_to_segment, N_DATA_BANDS, TARGET_SIZE, MODEL, batch_size, num_workers=min(batch_size, os.cpu_count() or 1))
         )
+
+    if prefetch > 0:
+        batches = prefetch_generator(batches, prefetch)
+
+    if profile == 'full':
+        # pyplot draws the overlay figures through the GUI backend, which only works
+        # on the main thread, so write the outputs there
+        num_writers = 0
+    if num_writers > 0:
+        writer = ThreadPoolExecutor(max_workers=num_writers)
+        # bound the number of results held in memory waiting to be written
+        max_pending = 4 * num_writers * batch_size
+    pending = deque()
+    failed = []
+
+    try:
+        for files, batch_images, sizes, bigimages, georefs in tqdm.auto.tqdm(batches, total=num_batches):
+            start = time.perf_counter()
+            results = predict_batch(batch_images, sizes, model_list, MODEL, NCLASSES, TARGET_SIZE, TESTTIMEAUG, OTSU_THRESHOLD, fast_resize=fast_resize, upsample=upsample)
+            metrics["inference_seconds"] += time.perf_counter() - start
+            metrics["num_images"] += len(batch_images)
+
+            for f, result, bigimage, georef in zip(files, results, bigimages, georefs):
+                args = (
+                    f, get_segfile(f, sample_direc, out_dir_name), result, bigimage, dict(metadatadict, **georef),
+                    NCLASSES, N_DATA_BANDS, WRITE_MODELMETADATA
+                )
+                if num_writers > 0:
+                    failed += wait_for_writes(pending, max_pending - 1)
+                    pending.append((f, writer.submit(write_seg_outputs, *args, profile=profile, write_label_tif=write_label_tif, prob_dtype=prob_dtype, lean_metadata=lean_metadata)))
+                else:
+                    write_seg_outputs(*args, profile=profile, write_label_tif=write_label_tif, prob_dtype=prob_dtype, lean_metadata=lean_metadata)
+    finally:
+        # flush the remaining outputs, also if inference stopped early
+        if num_writers > 0:
+            failed += wait_for_writes(pending)
+            writer.shutdown()
+        end_segmentation_session()
+
+    if len(failed) > 0:
+        print("Outputs of {} files could not be written:".format(len(failed)))
+        for f in failed:
+            print(f)
+
+    metrics["seconds_per_image"] = metrics["inference_seconds"] / max(metrics["num_images"], 1)
+    print("Inference : {:.3f} s per image ({} images)".format(metrics["seconds_per_image"], metrics["num_images"]))
+    return metrics
@@ -0,0 +1,671 @@
+# standard imports
+import os, json, time
+import tqdm
+
+# external imports
+import numpy as np
+
+## geospatial imports
+from osgeo import gdal
+
+# local imports
+import model_inference_funcs
+
+
+def get_nodata_value(image_ortho: str, default: float = 0) -> float:
+    """returns the nodata value of the first band of image_ortho, or default if it has none
+
+    Args:
+        image_ortho (str): full path to orthomosaic
+        default (float, optional): value returned if the band has no nodata value. Defaults to 0.
+
+    Returns:
+        float: nodata value
+    """
+    ds = gdal.Open(image_ortho)
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    ds = None # close ds
+    if nodata is None:
+        return default
+    return nodata
+
+
+def is_empty_tile(f: str, nodata: float = 0, sample_size: int = 128) -> bool:
+    """returns True if tile f is all nodata, or constant
+
+    Only a strided sample of the tile, at most sample_size x sample_size pixels, is read
+    (gdal decimated read, which the JPEG and tiled GeoTIFF drivers serve without
+    decoding the full tile), so this is much cheaper than decoding and standardizing it
+
+    Args:
+        f (str): full path to tile
+        nodata (float, optional): nodata value of the orthomosaic. Defaults to 0.
+        sample_size (int, optional): maximum size of the sample in each dimension. Defaults to 128.
+
+    Returns:
+        bool: True if the sample is all nodata or constant
+    """
+    ds = gdal.Open(f)
+    sample = ds.ReadAsArray(
+        buf_xsize=min(sample_size, ds.RasterXSize),
+        buf_ysize=min(sample_size, ds.RasterYSize)
+    )
+    ds = None # close ds
+    return is_empty_image(sample, nodata)
+
+
+def is_empty_image(image: np.ndarray, nodata: float = 0) -> bool:
+    """returns True if image (e.g. a tile from iter_tiles) is all nodata, or constant"""
+    return bool(np.all(image == nodata) or np.ptp(image) == 0)
+
+
+def get_empty_tile_index(tile_files: list, index_file: str, nodata: float = 0, sample_size: int = 128) -> list:
+    """returns the tiles in tile_files that are all nodata or constant (see is_empty_tile),
+    so they can be skipped by inference and stitching
+
+    The index is cached in index_file (json) and only rebuilt if tile_files changed
+
+    Args:
+        tile_files (list): full paths to tiles
+        index_file (str): full path to json file caching the index
+        nodata (float, optional): nodata value of the orthomosaic. Defaults to 0.
+        sample_size (int, optional): maximum size of the sample read from each tile. Defaults to 128.
+
+    Returns:
+        list: full paths to empty tiles
+    """
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if sorted(index["tiles"]) == sorted(tile_files) and index["nodata"] == nodata:
+            return index["empty_tiles"]
+
+    empty_tiles = [f for f in tile_files if is_empty_tile(f, nodata, sample_size)]
+
+    with open(index_file, "w") as f:
+        json.dump({"nodata": nodata, "tiles": tile_files, "empty_tiles": empty_tiles}, f)
+    return empty_tiles
+
+
+def get_tile_windows(xsize: int, ysize: int, tile_size: int, overlap: int) -> list:
+    """returns the windows of the tiles covering a raster of xsize x ysize pixels,
+    on the same grid as gdal_retile.py -ps tile_size tile_size -overlap overlap
+    (tiles on the right and bottom edges may be smaller than tile_size)
+
+    Args:
+        xsize (int): raster width
+        ysize (int): raster height
+        tile_size (int): tile width and height
+        overlap (int): overlap of neighbouring tiles (px)
+
+    Returns:
+        list: (row, col, xoff, yoff, width, height) of each tile, row by row, row and col starting at 1
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError("overlap ({} px) must be at least 0 and less than the tile size ({} px)".format(overlap, tile_size))
+    stride = tile_size - overlap
+    xoffs = range(0, max(xsize - overlap, 1), stride)
+    yoffs = range(0, max(ysize - overlap, 1), stride)
+    return [
+        (row+1, col+1, xoff, yoff, min(tile_size, xsize - xoff), min(tile_size, ysize - yoff))
+        for row, yoff in enumerate(yoffs)
+        for col, xoff in enumerate(xoffs)
+    ]
+
+
+def get_tile_geotransform(geotransform: tuple, xoff: int, yoff: int) -> tuple:
+    """returns the geotransform of the window of a raster starting at pixel (xoff, yoff)"""
+    return (
+        geotransform[0] + xoff * geotransform[1] + yoff * geotransform[2],
+        geotransform[1],
+        geotransform[2],
+        geotransform[3] + xoff * geotransform[4] + yoff * geotransform[5],
+        geotransform[4],
+        geotransform[5],
+    )
+
+
+def iter_tiles(image_ortho: str, tile_size: int, overlap: int, bands: list = [1, 2, 3]):
+    """generator of the overlapping tiles of an orthomosaic, read in-process with gdal
+    (no tile files). Each row of tiles is read from the ortho as one full-width strip,
+    so every block of the ortho is decoded once per strip rather than once per tile
+
+    Args:
+        image_ortho (str): full path to orthomosaic
+        tile_size (int): tile width and height
+        overlap (int): overlap of neighbouring tiles (px)
+        bands (list, optional): bands to read. Defaults to [1, 2, 3].
+
+    Yields:
+        dict: "name" (gdal_retile.py style tile name, without extension), "image" ((height, width, bands) uint8),
+        "geotransform" and "projection" of the tile, and its "window" (xoff, yoff, width, height)
+    """
+    ds = gdal.Open(image_ortho)
+    geotransform = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+
+    windows = get_tile_windows(ds.RasterXSize, ds.RasterYSize, tile_size, overlap)
+    ndigits_row = len(str(windows[-1][0]))
+    ndigits_col = len(str(windows[-1][1]))
+    root = os.path.splitext(os.path.basename(image_ortho))[0]
+
+    strip_yoff = None
+    for row, col, xoff, yoff, width, height in windows:
+        if yoff != strip_yoff:
+            # -ot Byte
+            strip = ds.ReadAsArray(0, yoff, ds.RasterXSize, height, band_list=bands, buf_type=gdal.GDT_Byte)
+            strip = np.transpose(strip.reshape((len(bands), height, ds.RasterXSize)), (1, 2, 0))
+            strip_yoff = yoff
+
+        yield {
+            "name": "{}_{}_{}".format(root, str(row).zfill(ndigits_row), str(col).zfill(ndigits_col)),
+            "image": strip[:, xoff:xoff+width],
+            "geotransform": get_tile_geotransform(geotransform, xoff, yoff),
+            "projection": projection,
+            "window": (xoff, yoff, width, height),
+        }
+    ds = None # close ds
+
+
+def get_tiling_cost(xsize: int, ysize: int, tile_size: int, overlap: int, NCLASSES: int, seconds_per_tile: float = None, streaming: bool = True) -> dict:
+    """returns the cost of segmenting a raster of xsize x ysize pixels with tiles of tile_size
+    overlapping by overlap pixels (the grid of get_tile_windows)
+
+    Scratch disk is a rough estimate. The scores accumulator of create_mosaic is uncompressed,
+    (NCLASSES + 1) x 4 bytes/px of the whole raster (e.g. 40 bytes/px for 9 classes), until the mosaics
+    are written and it is removed. The mosaics are at most 1 + NCLASSES x 4 bytes/px before compression.
+    Without streaming, the tile files add the jpeg tiles (~0.5 bytes/px), colour label pngs (~0.5 bytes/px)
+    and "_res.npz" scores (~2 x NCLASSES float32 per px, they compress little)
+
+    Args:
+        xsize (int): raster width
+        ysize (int): raster height
+        tile_size (int): tile width and height
+        overlap (int): overlap of neighbouring tiles (px)
+        NCLASSES (int): number of classes used in segmentation model
+        seconds_per_tile (float, optional): measured inference latency per tile. Defaults to None.
+        streaming (bool, optional): windows are segmented without tile files. Defaults to True.
+
+    Returns:
+        dict: "overlap", "stride", "num_tiles", "inference_seconds" (None without seconds_per_tile)
+        "accumulator_bytes" (of the scores accumulator) and "scratch_bytes" (total, with the accumulator)
+    """
+    windows = get_tile_windows(xsize, ysize, tile_size, overlap)
+    tile_pixels = sum(w[4] * w[5] for w in windows)
+    accumulator_bytes = xsize * ysize * (NCLASSES + 1) * 4
+    mosaic_bytes = accumulator_bytes + xsize * ysize * (1 + NCLASSES * 4)
+    if not streaming:
+        mosaic_bytes += tile_pixels * (0.5 + 0.5 + 2 * NCLASSES * 4)
+    return {
+        "overlap": overlap,
+        "stride": tile_size - overlap,
+        "num_tiles": len(windows),
+        "inference_seconds": None if seconds_per_tile is None else len(windows) * seconds_per_tile,
+        "accumulator_bytes": int(accumulator_bytes),
+        "scratch_bytes": int(mosaic_bytes),
+    }
+
+
+def measure_seconds_per_tile(image_ortho: str, model_list: list, MODEL: str, NCLASSES: int, N_DATA_BANDS: int,
+                             TARGET_SIZE: tuple, TESTTIMEAUG: bool, overlap: int, batch_size: int = 1, num_batches: int = 3,
+                             tile_size: int = None) -> float:
+    """measures the inference latency per tile on the first non-empty tiles of an orthomosaic,
+    after one warm-up batch that is not timed
+
+    Args:
+        image_ortho (str): full path to orthomosaic
+        model_list (list): list of loaded models
+        MODEL (str): model type
+        NCLASSES (int): number of classes used in segmentation model
+        N_DATA_BANDS (int): number of bands in imagery
+        TARGET_SIZE (tuple): size the tiles are resized to before inference
+        TESTTIMEAUG (bool): use test-time augmentation
+        overlap (int): overlap of neighbouring tiles (px)
+        batch_size (int, optional): number of tiles per forward pass. Defaults to 1.
+        num_batches (int, optional): number of timed batches. Defaults to 3.
+        tile_size (int, optional): tile width and height. Defaults to None (TARGET_SIZE[0]).
+
+    Returns:
+        float: seconds per tile
+    """
+    if tile_size is None:
+        tile_size = TARGET_SIZE[0]
+    images, sizes = [], []
+    for tile in iter_tiles(image_ortho, tile_size, overlap):
+        image, w, h, _ = model_inference_funcs.get_image_from_array(tile["image"], N_DATA_BANDS, TARGET_SIZE, MODEL)
+        if np.std(image) > 0:
+            images.append(image)
+            sizes.append((int(w), int(h)))
+        if len(images) == (num_batches + 1) * batch_size:
+            break
+    if len(images) == 0:
+        return 0.0
+
+    seconds, num_tiles = 0.0, 0
+    for k, start in enumerate(range(0, len(images), batch_size)):
+        t = time.perf_counter()
+        model_inference_funcs.predict_batch(
+            images[start:start+batch_size], sizes[start:start+batch_size], model_list, MODEL, NCLASSES, TARGET_SIZE, TESTTIMEAUG, False, fast_resize=True
+        )
+        if k > 0:
+            seconds += time.perf_counter() - t
+            num_tiles += len(images[start:start+batch_size])
+    return seconds / max(num_tiles, 1)
+
+
+def print_tiling_report(image_ortho: str, tile_size: int, overlaps: list, NCLASSES: int, seconds_per_tile: float = None, streaming: bool = True) -> list:
+    """prints the cost (get_tiling_cost) of segmenting an orthomosaic with each of overlaps.
+    The scratch disk includes the uncompressed scores accumulator, (NCLASSES + 1) x 4 bytes/px
+
+    Args:
+        image_ortho (str): full path to orthomosaic
+        tile_size (int): tile width and height
+        overlaps (list): overlaps of neighbouring tiles (px) to compare
+        NCLASSES (int): number of classes used in segmentation model
+        seconds_per_tile (float, optional): measured inference latency per tile. Defaults to None.
+        streaming (bool, optional): windows are segmented without tile files. Defaults to True.
+
+    Returns:
+        list: cost of each overlap
+    """
+    ds = gdal.Open(image_ortho)
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    ds = None # close ds
+
+    print("{} : {} x {} px, {} px tiles".format(image_ortho, xsize, ysize, tile_size))
+    if seconds_per_tile is not None:
+        print("Measured inference : {:.3f} s per tile".format(seconds_per_tile))
+    costs = [get_tiling_cost(xsize, ysize, tile_size, overlap, NCLASSES, seconds_per_tile, streaming) for overlap in overlaps]
+    print("{:>10} {:>8} {:>8} {:>14} {:>16} {:>12}".format("overlap px", "stride", "tiles", "inference h", "accumulator GB", "scratch GB"))
+    for cost in costs:
+        print("{:>10} {:>8} {:>8} {:>14} {:>16.2f} {:>12.2f}".format(
+            cost["overlap"], cost["stride"], cost["num_tiles"],
+            "-" if cost["inference_seconds"] is None else "{:.2f}".format(cost["inference_seconds"] / 3600),
+            cost["accumulator_bytes"] / 1e9, cost["scratch_bytes"] / 1e9
+        ))
+    return costs
+
+
+def write_tile(f: str, image: np.ndarray, geotransform: tuple, projection: str, driver: str = "JPEG", options: list = []) -> None:
+    """writes a (height, width, bands) uint8 image with its georeferencing.
+    For formats without a geotransform (JPEG, PNG) gdal writes it to an .aux.xml sidecar
+
+    Args:
+        f (str): full path to output file
+        image (np.ndarray): (height, width, bands) uint8 image
+        geotransform (tuple): gdal geotransform of the image
+        projection (str): projection of the image (WKT)
+        driver (str, optional): gdal driver name. Defaults to "JPEG".
+        options (list, optional): gdal creation options. Defaults to [].
+    """
+    if np.ndim(image) == 2:
+        image = image[:, :, np.newaxis]
+    height, width, nbands = image.shape
+    mem = gdal.GetDriverByName("MEM").Create("", width, height, nbands, gdal.GDT_Byte)
+    mem.SetGeoTransform(geotransform)
+    mem.SetProjection(projection)
+    for i in range(nbands):
+        mem.GetRasterBand(i+1).WriteArray(image[:, :, i])
+    ds = gdal.GetDriverByName(driver).CreateCopy(f, mem, options=options)
+    ds = None # close and save ds
+    mem = None
+
+
+def get_blend_window(n: int, blend: str = "hann") -> np.ndarray:
+    """returns the weights of the n pixels across a window, in one dimension
+
+    Args:
+        n (int): window size
+        blend (str, optional): "hann" (sin^2 taper to almost 0 at the window edges, sampled at pixel
+            centres so no weight is exactly 0) or "mean" (uniform weights). Defaults to "hann".
+
+    Returns:
+        np.ndarray: (n,) float32 weights
+    """
+    if blend == "mean":
+        return np.ones(n, dtype=np.float32)
+    return (np.sin(np.pi * (np.arange(n) + 0.5) / n) ** 2).astype(np.float32)
+
+
+# creation options of the Cloud Optimized GeoTIFF mosaics (see write_cog), overviews are added by the COG driver
+COG_OPTIONS = ["COMPRESS=LZW", "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS", "OVERVIEWS=AUTO"]
+
+
+def write_cog(f: str, resampling: str = "NEAREST") -> None:
+    """rewrites a GeoTIFF as a Cloud Optimized GeoTIFF (tiled, internal overviews down to a single tile),
+    so viewers can read it at any scale without reading it whole. Overviews are built on all CPUs
+
+    Args:
+        f (str): full path to GeoTIFF, replaced in place
+        resampling (str, optional): resampling of the overviews, "NEAREST" (or "MODE") for labels,
+            "AVERAGE" for scores. Defaults to "NEAREST".
+    """
+    tmp = os.path.splitext(f)[0] + "_cog.tif"
+    gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+    ds = gdal.Translate(destName=tmp, srcDS=f, format="COG", creationOptions=COG_OPTIONS + ["RESAMPLING=" + resampling])
+    ds = None # close and save ds
+    os.replace(tmp, f)
+
+
+def write_label_rgb(out_label: str, out_rgb: str, driver: str = "COG", options: list = None) -> None:
+    """writes an RGB copy of a label GeoTIFF made by create_mosaic, by expanding its color table
+
+    Args:
+        out_label (str): full path to label GeoTIFF
+        out_rgb (str): full path to output RGB image
+        driver (str, optional): gdal driver name. Defaults to "COG" (Cloud Optimized GeoTIFF, with overviews).
+        options (list, optional): gdal creation options. Defaults to None, COG_OPTIONS for "COG"
+            and compressed tiles for "GTiff".
+    """
+    if driver == "COG":
+        gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+        if options is None:
+            options = COG_OPTIONS + ["RESAMPLING=NEAREST"]
+    elif options is None:
+        options = ["NUM_THREADS=ALL_CPUS", "COMPRESS=LZW", "TILED=YES"] if driver == "GTiff" else []
+    ds = gdal.Translate(destName=out_rgb, srcDS=out_label, format=driver, rgbExpand="rgb", noData=0, creationOptions=options)
+    ds.FlushCache()
+    ds = None
+
+
+def write_label_rows(ds_acc, ds_label, yoff: int, height: int, chunk_size: int = 1024, ds_prob=None) -> None:
+    """writes the label of rows yoff to yoff+height of ds_label from the blended scores in ds_acc,
+    chunk_size columns at a time. The blended scores are the weighted scores divided by the
+    summed weights of the windows added there (add_window_scores). The label is 1 + the class
+    with the highest score, 0 (nodata) where no window was added
+
+    Args:
+        ds_acc (gdal.Dataset): scores accumulator of create_mosaic
+        ds_label (gdal.Dataset): label raster
+        yoff (int): first row
+        height (int): number of rows
+        chunk_size (int, optional): number of columns read at a time. Defaults to 1024.
+        ds_prob (gdal.Dataset, optional): float32 or uint8 scores raster (see create_mosaic), written
+            from the same rows. Defaults to None.
+    """
+    nbands = ds_acc.RasterCount
+    for xoff in range(0, ds_acc.RasterXSize, chunk_size):
+        width = min(chunk_size, ds_acc.RasterXSize - xoff)
+        acc = ds_acc.ReadAsArray(xoff, yoff, width, height).reshape((nbands, height, width))
+        weights = acc[-1]
+        covered = weights > 0
+        scores = np.divide(acc[:-1], weights, out=np.zeros_like(acc[:-1]), where=covered)
+        # (e1 + (1 - e0)) / 2 > 0.5 for binary models, i.e. argmax
+        label = 1 + np.argmax(scores, axis=0).astype(np.uint8)
+        label[~covered] = 0
+        ds_label.GetRasterBand(1).WriteArray(label, xoff, yoff)
+        if ds_prob is not None:
+            if ds_prob.GetRasterBand(1).DataType == gdal.GDT_Byte:
+                scores = np.round(np.clip(scores, 0, 1) * 255).astype(np.uint8)
+            for k in range(ds_prob.RasterCount):
+                ds_prob.GetRasterBand(k+1).WriteArray(scores[k], xoff, yoff)
+
+
+def create_mosaic(image_ortho: str, out_label: str, out_prob: str, NCLASSES: int, colormap: list = None, prob_dtype: str = "float32") -> tuple:
+    """creates the label and scores GeoTIFFs of an orthomosaic, on its grid.
+    out_prob has one band per class, described as "class k"
+
+    Scores are accumulated in place (add_window_scores) in an uncompressed float32 scratch raster
+    next to out_prob ("_acc.tif", removed by remove_accumulator), with one band per class and a last
+    band summing the weights of the windows added at each pixel. out_label and out_prob are written
+    from it by write_label_rows. out_prob is compressed, float32 or uint8 0-255 with a scale of 1/255
+    in its metadata
+
+    The accumulator takes (NCLASSES + 1) x 4 bytes/px of the orthomosaic on disk (e.g. 40 bytes/px, 4 GB
+    per 10^8 px, for 9 classes) until remove_accumulator. It is sparse, so only the parts already segmented
+    take space. get_tiling_cost / print_tiling_report include it in their scratch estimate
+
+    Args:
+        image_ortho (str): full path to orthomosaic
+        out_label (str): full path to output label GeoTIFF (uint8, 1 + class, 0 = nodata)
+        out_prob (str): full path to output scores GeoTIFF
+        NCLASSES (int): number of classes used in segmentation model
+        colormap (list, optional): hex colours of the classes, written as the color table of out_label.
+            Defaults to None.
+        prob_dtype (str, optional): "float32" or "uint8" ("float16" is written as "float32"). Defaults to "float32".
+
+    Returns:
+        tuple: ds_label, ds_acc (scores accumulator) and ds_prob (scores), open in update mode
+    """
+    ds = gdal.Open(image_ortho)
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    geotransform = ds.GetGeoTransform()
+    projection = ds.GetProjection()
+    ds = None # close ds
+
+    driver = gdal.GetDriverByName("GTiff")
+    compressed = ["TILED=YES", "BIGTIFF=IF_SAFER", "COMPRESS=LZW", "NUM_THREADS=ALL_CPUS"]
+    ds_label = driver.Create(out_label, xsize, ysize, 1, gdal.GDT_Byte, options=compressed)
+    ds_prob = driver.Create(out_prob, xsize, ysize, NCLASSES, gdal.GDT_Byte if prob_dtype == "uint8" else gdal.GDT_Float32, options=compressed)
+    ds_acc = driver.Create(out_prob.replace(".tif", "_acc.tif"), xsize, ysize, NCLASSES + 1, gdal.GDT_Float32, options=["TILED=YES", "BIGTIFF=IF_SAFER", "SPARSE_OK=TRUE"])
+
+    for out in [ds_acc, ds_label, ds_prob]:
+        out.SetGeoTransform(geotransform)
+        out.SetProjection(projection)
+    for k in range(NCLASSES):
+        band = ds_prob.GetRasterBand(k+1)
+        band.SetDescription("class {}".format(k))
+        if prob_dtype == "uint8":
+            band.SetScale(1 / 255)
+            band.SetOffset(0)
+    ds_label.GetRasterBand(1).SetNoDataValue(0)
+    if colormap is not None:
+        ds_label.GetRasterBand(1).SetRasterColorTable(model_inference_funcs.get_color_table(colormap[:NCLASSES]))
+    return ds_label, ds_acc, ds_prob
+
+
+def remove_accumulator(out_prob: str) -> None:
+    """removes the scratch scores accumulator of create_mosaic. The rasters from create_mosaic must be closed first"""
+    gdal.GetDriverByName("GTiff").Delete(out_prob.replace(".tif", "_acc.tif"))
+
+
+def add_window_scores(ds_acc, scores: np.ndarray, window: tuple, blend: str = "hann") -> None:
+    """adds the (height, width, NCLASSES) scores of a window, times its blending weights
+    (get_blend_window along its rows times along its columns), into ds_acc, and the weights
+    into its last band. Empty windows (all-zero scores) are skipped, so they add no weight
+
+    Args:
+        ds_acc (gdal.Dataset): scores accumulator of create_mosaic
+        scores (np.ndarray): scores of the window at native size
+        window (tuple): (xoff, yoff, width, height) of the window
+        blend (str, optional): see get_blend_window. Defaults to "hann".
+    """
+    xoff, yoff, width, height = window
+    if np.ndim(scores) != 3 or not np.any(scores):
+        return
+    weights = get_blend_window(height, blend)[:, None] * get_blend_window(width, blend)[None, :]
+    scores = np.concatenate((scores * weights[:, :, None], weights[:, :, None]), axis=-1)
+    nbands = ds_acc.RasterCount
+    blended = ds_acc.ReadAsArray(xoff, yoff, width, height).reshape((nbands, height, width))
+    for k in range(nbands):
+        ds_acc.GetRasterBand(k+1).WriteArray(blended[k] + scores[:, :, k], xoff, yoff)
+
+
+def stitch_tiles(
+    image_ortho: str,
+    npz_files: list,
+    out_label: str,
+    out_prob: str,
+    NCLASSES: int,
+    tile_size: int,
+    overlap: int,
+    blend: str = "hann",
+    colormap: list = None,
+    prob_dtype: str = "float32",
+    tile_files: list = None,
+    cog: bool = True,
+) -> None:
+    """stitches the "av_softmax_scores" of segmented orthomosaic tiles (the "_res.npz" files
+    written by model_inference_funcs.compute_segmentation) into label and scores GeoTIFFs.
+    Overlapping tiles are blended (add_window_scores) and the label is the argmax of the blended scores.
+    Tiles are placed by the "geotransform" in their "_res.npz" file (tiles segmented in memory),
+    or else by the georeferencing of their tile file, and must be on the grid of tile_size tiles
+    overlapping by overlap pixels they were cut on (get_tile_windows)
+
+    Args:
+        image_ortho (str): full path to orthomosaic the tiles were cut from
+        npz_files (list): full paths to the "_res.npz" file of each tile
+        out_label (str): full path to output label GeoTIFF
+        out_prob (str): full path to output scores GeoTIFF
+        NCLASSES (int): number of classes used in segmentation model
+        tile_size (int): tile width and height the tiles were cut at
+        overlap (int): overlap of neighbouring tiles (px) the tiles were cut with
+        blend (str, optional): see get_blend_window. Defaults to "hann".
+        colormap (list, optional): see create_mosaic. Defaults to None.
+        prob_dtype (str, optional): see create_mosaic. Defaults to "float32".
+        tile_files (list, optional): full paths to the georeferenced tile of each "_res.npz" file. Defaults to None.
+        cog (bool, optional): write the mosaics as Cloud Optimized GeoTIFFs with overviews (write_cog). Defaults to True.
+    """
+    ds_label, ds_acc, ds_prob = create_mosaic(image_ortho, out_label, out_prob, NCLASSES, colormap, prob_dtype)
+    xsize, ysize = ds_acc.RasterXSize, ds_acc.RasterYSize
+    geotransform = ds_acc.GetGeoTransform()
+    grid = set((w[2], w[3]) for w in get_tile_windows(xsize, ysize, tile_size, overlap))
+
+    for i, k in enumerate(tqdm.auto.tqdm(npz_files)):
+        with np.load(k) as data:
+            scores = model_inference_funcs.load_scores(data)
+            if "geotransform" in data:
+                tile_geotransform = tuple(data["geotransform"])
+            else:
+                ds = gdal.Open(tile_files[i])
+                tile_geotransform = ds.GetGeoTransform()
+                ds = None # close ds
+        xoff = int(round((tile_geotransform[0] - geotransform[0]) / geotransform[1]))
+        yoff = int(round((tile_geotransform[3] - geotransform[3]) / geotransform[5]))
+        if (xoff, yoff) not in grid:
+            ds_label = ds_acc = ds_prob = None # close ds
+            remove_accumulator(out_prob)
+            raise ValueError("{} is not on the grid of {} px tiles overlapping by {} px".format(k, tile_size, overlap))
+        add_window_scores(ds_acc, scores, (xoff, yoff, scores.shape[1], scores.shape[0]), blend)
+
+    # one block row of the label mosaic at a time, so memory is bounded by a strip, not the mosaic height
+    label_block_size = ds_label.GetRasterBand(1).GetBlockSize()[1]
+    for label_yoff in range(0, ysize, label_block_size):
+        write_label_rows(ds_acc, ds_label, label_yoff, min(label_block_size, ysize - label_yoff), ds_prob=ds_prob)
+    ds_label = ds_acc = ds_prob = None # close and save ds
+    remove_accumulator(out_prob)
+
+    if cog:
+        write_cog(out_label, "NEAREST")
+        write_cog(out_prob, "AVERAGE")
+
+
+def segment_orthomosaic(
+    image_ortho: str,
+    out_label: str,
+    out_prob: str,
+    model_list: list,
+    MODEL: str,
+    NCLASSES: int,
+    N_DATA_BANDS: int,
+    TARGET_SIZE: tuple,
+    TESTTIMEAUG: bool,
+    overlap: int,
+    batch_size: int = None,
+    bands: list = [1, 2, 3],
+    blend: str = "hann",
+    fuse_ensemble: bool = False,
+    trace_models: bool = False,
+    colormap: list = None,
+    prob_dtype: str = "float32",
+    cog: bool = True,
+    tile_size: int = None,
+) -> dict:
+    """segments an orthomosaic window by window, without tile files.
+
+    A tile_size window slides over the ortho with the given overlap (the gdal_retile.py grid
+    of get_tile_windows). Each batch of windows is read in-process (iter_tiles), segmented with
+    predict_batch, and its scores, weighted so that overlapping windows are blended,
+    are added with their weights into a float32 accumulator with one band per class (add_window_scores)
+    opened in update mode. Once every window covering a row has been added, the rows of out_label
+    (uint8, 1 + class, 0 = nodata) and out_prob are written from the scores divided by the summed
+    weights. Memory is bounded by a strip of the ortho and a batch of windows; the output rasters
+    and the accumulator (removed at the end) are the only files written
+
+    Args:
+        image_ortho (str): full path to orthomosaic
+        out_label (str): full path to output label GeoTIFF
+        out_prob (str): full path to output scores GeoTIFF
+        model_list (list): list of loaded models
+        MODEL (str): model type
+        NCLASSES (int): number of classes used in segmentation model
+        N_DATA_BANDS (int): number of bands in imagery
+        TARGET_SIZE (tuple): size the windows are resized to before inference
+        TESTTIMEAUG (bool): use test-time augmentation
+        overlap (int): overlap of neighbouring windows (px)
+        batch_size (int, optional): number of windows per forward pass. None picks a batch size
+            from the available memory. Defaults to None.
+        bands (list, optional): bands of the ortho to read. Defaults to [1, 2, 3].
+        blend (str, optional): weighting of overlapping windows, see get_blend_window. Defaults to "hann".
+        fuse_ensemble (bool, optional): see model_inference_funcs.compute_segmentation. Defaults to False.
+        trace_models (bool, optional): see model_inference_funcs.compute_segmentation. Defaults to False.
+        colormap (list, optional): hex colours of the classes, written as the color table of out_label.
+            Defaults to None.
+        prob_dtype (str, optional): "float32" or "uint8" (quantised) out_prob, see create_mosaic. Defaults to "float32".
+        cog (bool, optional): write the mosaics as Cloud Optimized GeoTIFFs with overviews (write_cog). Defaults to True.
+        tile_size (int, optional): window width and height, overlap is relative to it. Defaults to None (TARGET_SIZE[0]).
+
+    Returns:
+        dict: timing metrics of the run, as model_inference_funcs.compute_segmentation
+    """
+    if batch_size is None:
+        batch_size = model_inference_funcs.get_batch_size(TARGET_SIZE, N_DATA_BANDS, NCLASSES)
+        print("Using batch size : {}".format(batch_size))
+
+    if fuse_ensemble:
+        model_list = model_inference_funcs.get_fused_ensemble(model_list, MODEL)
+
+    metrics = {"warmup_seconds": 0.0, "num_images": 0, "inference_seconds": 0.0}
+    if trace_models:
+        model_list = [model_inference_funcs.get_traced_model(model, MODEL, TARGET_SIZE, N_DATA_BANDS) for model in model_list]
+        metrics["warmup_seconds"] = model_inference_funcs.warm_up_models(model_list, MODEL, TARGET_SIZE, N_DATA_BANDS)
+        print("Model warm-up : {:.2f} s".format(metrics["warmup_seconds"]))
+
+    ds_label, ds_acc, ds_prob = create_mosaic(image_ortho, out_label, out_prob, NCLASSES, colormap, prob_dtype)
+    xsize, ysize = ds_acc.RasterXSize, ds_acc.RasterYSize
+    # label rows are written a whole block row at a time, so compressed blocks are written once
+    label_block_size = ds_label.GetRasterBand(1).GetBlockSize()[1]
+
+    if tile_size is None:
+        tile_size = TARGET_SIZE[0]
+    windows = get_tile_windows(xsize, ysize, tile_size, overlap)
+    print("{} windows".format(len(windows)))
+
+    tiles = iter_tiles(image_ortho, tile_size, overlap, bands=bands)
+    label_yoff = 0
+    try:
+        for start in tqdm.auto.tqdm(range(0, len(windows), batch_size)):
+            batch = [next(tiles) for _ in windows[start:start+batch_size]]
+            decoded = [model_inference_funcs.get_image_from_array(tile["image"], N_DATA_BANDS, TARGET_SIZE, MODEL) for tile in batch]
+            images = [d[0] for d in decoded]
+            sizes = [(int(d[1]), int(d[2])) for d in decoded]
+
+            t = time.perf_counter()
+            results = model_inference_funcs.predict_batch(
+                images, sizes, model_list, MODEL, NCLASSES, TARGET_SIZE, TESTTIMEAUG, False, fast_resize=True
+            )
+            metrics["inference_seconds"] += time.perf_counter() - t
+            metrics["num_images"] += len(images)
+
+            for result, tile in zip(results, batch):
+                add_window_scores(ds_acc, result["av_softmax_scores"], tile["window"], blend)
+
+            # rows above the next window have all their windows added
+            done = windows[start+batch_size][3] if start+batch_size < len(windows) else ysize
+            if done < ysize:
+                done -= done % label_block_size
+            if done > label_yoff:
+                write_label_rows(ds_acc, ds_label, label_yoff, done - label_yoff, ds_prob=ds_prob)
+                label_yoff = done
+    finally:
+        ds_label = ds_acc = ds_prob = None # close and save ds
+        remove_accumulator(out_prob)
+        model_inference_funcs.end_segmentation_session()
+
+    if cog:
+        write_cog(out_label, "NEAREST")
+        write_cog(out_prob, "AVERAGE")
+
+    metrics["seconds_per_image"] = metrics["inference_seconds"] / max(metrics["num_images"], 1)
+    print("Inference : {:.3f} s per window ({} windows)".format(metrics["seconds_per_image"], metrics["num_images"]))
+    return metrics
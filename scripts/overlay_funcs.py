@@ -0,0 +1,229 @@
+# standard imports
+import os
+
+# external imports
+import numpy as np
+from skimage.io import imsave
+
+## geospatial imports
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
+
+def get_overview_level(f: str, max_size: int, window: Window = None):
+    """returns the overview level of raster f (or of a window of it) closest to max_size pixels
+    (its longest side) without being smaller, or None if the full resolution raster is the closest
+
+    Args:
+        f (str): full path to raster
+        max_size (int): longest side of the display (px)
+        window (Window, optional): window of the raster at full resolution. Defaults to None (whole raster).
+
+    Returns:
+        int: overview level (0 is the first overview), or None
+    """
+    with rasterio.open(f) as dataset:
+        if window is None:
+            size = max(dataset.width, dataset.height)
+        else:
+            size = max(window.width, window.height)
+        factors = dataset.overviews(1)
+    level = None
+    for k, factor in enumerate(factors):
+        if size / factor >= max_size:
+            level = k
+    return level
+
+
+def read_window(f: str, max_size: int, window: Window = None, bands: list = None, resampling=Resampling.nearest, out_shape: tuple = None) -> np.ndarray:
+    """reads a window of raster f decimated to about max_size pixels (its longest side), from the overview level
+    matching that size (get_overview_level), so only that overview, and only the window, is read
+
+    Args:
+        f (str): full path to raster
+        max_size (int): longest side of the output (px)
+        window (Window, optional): window of the raster at full resolution. Defaults to None (whole raster).
+        bands (list, optional): bands to read, 1-based. Defaults to None (all bands).
+        resampling (optional): resampling of the decimation. Defaults to Resampling.nearest.
+        out_shape (tuple, optional): (height, width) of the output, instead of max_size. Defaults to None.
+
+    Returns:
+        np.ndarray: (height, width, bands) image, or (height, width) if it has one band
+    """
+    with rasterio.open(f) as dataset:
+        full_width, full_height = dataset.width, dataset.height
+    if window is None:
+        window = Window(0, 0, full_width, full_height)
+    if out_shape is None:
+        scale = min(1, max_size / max(window.width, window.height))
+        out_shape = (max(1, int(window.height * scale)), max(1, int(window.width * scale)))
+
+    level = get_overview_level(f, max(out_shape), window)
+    kwargs = {} if level is None else {"overview_level": level}
+    with rasterio.open(f, **kwargs) as dataset:
+        if bands is None:
+            bands = list(dataset.indexes)
+        # window in the pixels of the overview
+        fx, fy = full_width / dataset.width, full_height / dataset.height
+        window = Window(window.col_off / fx, window.row_off / fy, window.width / fx, window.height / fy)
+        image = dataset.read(bands, window=window, out_shape=(len(bands),) + tuple(out_shape), resampling=resampling, boundless=True)
+
+    # bands last (the arrays are band first, so this is a transpose, not a reshape)
+    image = np.transpose(image, (1, 2, 0))
+    return image[:, :, 0] if image.shape[2] == 1 else image
+
+
+def read_overview(f: str, max_size: int, bands: list = None, resampling=Resampling.nearest) -> np.ndarray:
+    """reads the whole of raster f at about max_size pixels (its longest side), see read_window"""
+    return read_window(f, max_size, bands=bands, resampling=resampling)
+
+
+def get_label_lut(label_ortho: str, alpha: float = 0.5) -> tuple:
+    """returns the colour lookup table of a label raster: its color table if it has one
+    (e.g. the mosaics of segment_orthomosaic.py), else the class colours of model_inference_funcs
+    (get_color_lut) by label value. The nodata value is transparent
+
+    Args:
+        label_ortho (str): full path to label raster
+        alpha (float, optional): opacity of the labels. Defaults to 0.5.
+
+    Returns:
+        tuple: (256, 3) uint8 colours and (256,) float32 opacities of each label value
+    """
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    lut_alpha = np.full(256, alpha, dtype=np.float32)
+    with rasterio.open(label_ortho) as dataset:
+        try:
+            colormap = dataset.colormap(1)
+        except ValueError:
+            colormap = None
+        nodata = dataset.nodata
+
+    if colormap is not None:
+        for value, color in colormap.items():
+            lut[value] = color[:3]
+            lut_alpha[value] = alpha * color[3] / 255
+    else:
+        # imported here, only label rasters without a color table need it (it imports tensorflow)
+        from model_inference_funcs import get_color_lut
+        lut[:] = get_color_lut(len(lut))
+    if nodata is not None:
+        lut_alpha[int(nodata)] = 0
+    return lut, lut_alpha
+
+
+def get_image_max(image_ortho: str, max_size: int = 1024) -> float:
+    """returns the maximum of an image mosaic, from its first three bands read at about max_size pixels
+    (read_overview), to stretch every part of it the same way (to_uint8). 255 for uint8 mosaics"""
+    with rasterio.open(image_ortho) as dataset:
+        if dataset.dtypes[0] == "uint8":
+            return 255.0
+        bands = list(dataset.indexes)[:3]
+    return float(np.max(read_overview(image_ortho, max_size, bands=bands)))
+
+
+def to_uint8(image: np.ndarray, max_value: float) -> np.ndarray:
+    """returns an image as uint8, scaled by max_value (get_image_max) if it is not uint8 already"""
+    if image.dtype == np.uint8:
+        return image
+    image = image.astype(np.float32)
+    return (255 * np.clip(image / max(max_value, 1e-6), 0, 1)).astype(np.uint8)
+
+
+def render_overlay(image_ortho: str, label_ortho: str, max_size: int, window: Window = None, alpha: float = 0.5, lut: tuple = None,
+                   out_shape: tuple = None, image_max: float = None) -> np.ndarray:
+    """renders the label mosaic over the image mosaic, as an RGB image of at most max_size pixels (its longest side).
+    Only the window of each mosaic, at the overview level matching max_size, is read (read_window).
+    The label colours are blended in with a lookup table (get_label_lut), label by label in numpy
+
+    Args:
+        image_ortho (str): full path to image mosaic
+        label_ortho (str): full path to label mosaic
+        max_size (int): longest side of the output (px)
+        window (Window, optional): window of the label mosaic at full resolution. Defaults to None (whole mosaic).
+        alpha (float, optional): opacity of the labels. Defaults to 0.5.
+        lut (tuple, optional): lookup table from get_label_lut, to reuse it. Defaults to None.
+        out_shape (tuple, optional): (height, width) of the output, instead of max_size. Defaults to None.
+        image_max (float, optional): stretch of the image mosaic from get_image_max, to reuse it. Defaults to None.
+
+    Returns:
+        np.ndarray: (height, width, 3) uint8 overlay
+    """
+    if lut is None:
+        lut = get_label_lut(label_ortho, alpha)
+    colors, opacity = lut
+    if image_max is None:
+        image_max = get_image_max(image_ortho)
+
+    label = read_window(label_ortho, max_size, window, bands=[1], out_shape=out_shape)
+    if window is None:
+        with rasterio.open(label_ortho) as dataset:
+            window = Window(0, 0, dataset.width, dataset.height)
+
+    # same ground extent in the image mosaic, which may be on another grid
+    with rasterio.open(label_ortho) as dataset:
+        extent = window_bounds(window, dataset.transform)
+    with rasterio.open(image_ortho) as dataset:
+        image_window = from_bounds(*extent, transform=dataset.transform)
+        bands = list(dataset.indexes)[:3]
+    image = to_uint8(read_window(image_ortho, max_size, image_window, bands=bands, resampling=Resampling.average, out_shape=label.shape[:2]), image_max)
+    if np.ndim(image) == 2:
+        image = np.dstack((image, image, image))
+
+    a = opacity[label][:, :, None]
+    return (image * (1 - a) + colors[label] * a).astype(np.uint8)
+
+
+def get_preview_windows(width: int, height: int, scale: int = 1, tile_size: int = 1024) -> list:
+    """returns the windows of the preview tiles of write_overlay_tiles over a mosaic of width x height pixels:
+    tile_size x scale pixels of the mosaic each (smaller on the right and bottom edges), decimated by scale
+
+    Args:
+        width (int): mosaic width
+        height (int): mosaic height
+        scale (int, optional): decimation of the previews (1 = full resolution). Defaults to 1.
+        tile_size (int, optional): width and height of the preview tiles (px). Defaults to 1024.
+
+    Returns:
+        list: (row, col, window, out_shape) of each tile, row by row, with the window at full resolution
+        and the (height, width) of the tile, the window divided by scale rounded up
+    """
+    step = tile_size * scale
+    windows = []
+    for row, row_off in enumerate(range(0, height, step)):
+        for col, col_off in enumerate(range(0, width, step)):
+            window = Window(col_off, row_off, min(step, width - col_off), min(step, height - row_off))
+            windows.append((row, col, window, (-(-window.height // scale), -(-window.width // scale))))
+    return windows
+
+
+def write_overlay_tiles(image_ortho: str, label_ortho: str, out_dir: str, scale: int = 1, tile_size: int = 1024, alpha: float = 0.5) -> list:
+    """writes the overlay of the label mosaic on the image mosaic (render_overlay) as tiled PNG previews,
+    one tile at a time, so memory is bounded by the tile size. Every tile is decimated by scale
+    (get_preview_windows, tiles on the right and bottom edges are smaller) and stretched by the same image maximum
+
+    Args:
+        image_ortho (str): full path to image mosaic
+        label_ortho (str): full path to label mosaic
+        out_dir (str): full path to output directory (created if needed)
+        scale (int, optional): decimation of the previews (1 = full resolution). Defaults to 1.
+        tile_size (int, optional): width and height of the preview tiles (px). Defaults to 1024.
+        alpha (float, optional): opacity of the labels. Defaults to 0.5.
+
+    Returns:
+        list: full paths to the preview tiles
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    lut = get_label_lut(label_ortho, alpha)
+    image_max = get_image_max(image_ortho)
+    with rasterio.open(label_ortho) as dataset:
+        width, height = dataset.width, dataset.height
+
+    root = os.path.splitext(os.path.basename(label_ortho))[0]
+    files = []
+    for row, col, window, out_shape in get_preview_windows(width, height, scale, tile_size):
+        overlay = render_overlay(image_ortho, label_ortho, tile_size, window, alpha, lut, out_shape, image_max)
+        f = os.path.join(out_dir, "{}_overlay_{}_{}.png".format(root, row, col))
+        imsave(f, overlay, check_contrast=False)
+        files.append(f)
+    return files
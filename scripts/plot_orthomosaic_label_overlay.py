@@ -26,14 +26,21 @@
 # standard imports
 from tkinter import filedialog
 from tkinter import *
-import sys, os, shutil, json
-from glob import glob
+import sys, os
 
-import numpy as np
-import matplotlib.pyplot as plt
-import rasterio
-import matplotlib
+from rasterio.windows import Window
+from skimage.io import imsave
 
+# local imports
+import overlay_funcs
+
+
+max_size = 2048 ## longest side of the overlay (px); only the overview level of the mosaics matching it is read (see segment_orthomosaic.py cog)
+alpha = 0.6 ## opacity of the labels
+window = None ## (col_off, row_off, width, height) of the label mosaic to render, in its pixels. None = the whole mosaic
+write_tiles = False ## if True, also write the overlay as tiled PNG previews to a "_overlay" folder next to the label mosaic
+tile_size = 1024 ## width and height of the preview tiles (px)
+tile_scale = 1 ## decimation of the preview tiles (1 = full resolution)
 
 ###############################################
 ################# INPUTS
@@ -53,50 +60,16 @@ print(label_ortho)
 root.withdraw()
 
 
-
-### read mosaic into memory
-print("Read label mosaic into memory ...")
-with rasterio.open(label_ortho) as dataset:
-    # Read the dataset's valid data mask as a ndarray.
-    label_raster = dataset.read()
-    profile_label = dataset.profile
-
-label_raster = np.squeeze(label_raster)
-
-### read mosaic into memory
-print("Read image mosaic into memory ...")
-with rasterio.open(image_ortho) as dataset:
-    # Read the dataset's valid data mask as a ndarray.
-    image_raster = dataset.read()#([1,2,3])
-    profile_image = dataset.profile
-
-print(image_raster.dtype, np.max(image_raster))
-nc, nx, ny = image_raster.shape
-image_raster = image_raster.reshape((nx,ny,nc))
-
-# image_raster = (255 * image_raster / np.max(image_raster)).astype(np.uint8)
-plt.imshow(image_raster)
-plt.show()
-
-image_raster = np.squeeze(image_raster)
-
-
-class_label_colormap = ['#3366CC','#DC3912','#FF9900','#109618','#990099','#0099C6','#DD4477',
-                        '#66AA00','#B82E2E', '#316395','#0d0887', '#46039f', '#7201a8',
-                        '#9c179e', '#bd3786', '#d8576b', '#ed7953', '#fb9f3a', '#fdca26', '#f0f921']
-
-NUM_LABEL_CLASSES = len(np.unique(label_raster.flatten()))
-
-class_label_colormap = class_label_colormap[:NUM_LABEL_CLASSES]
-cmap = matplotlib.colors.ListedColormap(class_label_colormap[:NUM_LABEL_CLASSES+1])
+if window is not None:
+    window = Window(*window)
 
 #Make an overlay
-plt.imshow(image_raster[:,:,:3])
-plt.imshow(label_raster, cmap=cmap, alpha=0.6, vmin=0, vmax=NUM_LABEL_CLASSES)
-plt.axis('off')
-if 'jpg' in i:
-    plt.savefig(i.replace('.jpg','_overlay.png'), dpi=200, bbox_inches='tight')
-elif 'jpeg' in i:
-    plt.savefig(i.replace('.jpeg','_overlay.png'), dpi=200, bbox_inches='tight')
-else:
-    plt.close()
+print("Render overlay at {} px ...".format(max_size))
+overlay = overlay_funcs.render_overlay(image_ortho, label_ortho, max_size, window=window, alpha=alpha)
+imsave(os.path.splitext(label_ortho)[0]+'_overlay.png', overlay, check_contrast=False)
+
+if write_tiles:
+    out_dir = os.path.splitext(label_ortho)[0]+'_overlay'
+    print("Write overlay tiles to {} ...".format(out_dir))
+    files = overlay_funcs.write_overlay_tiles(image_ortho, label_ortho, out_dir, scale=tile_scale, tile_size=tile_size, alpha=alpha)
+    print("{} tiles written".format(len(files)))
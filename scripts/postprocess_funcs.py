@@ -0,0 +1,307 @@
+# standard imports
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# external imports
+import numpy as np
+from scipy import ndimage
+from skimage.measure import label as label_components
+from skimage.morphology import disk, opening
+
+## geospatial imports
+import rasterio
+from rasterio.windows import Window
+
+
+def get_block_windows(width: int, height: int, block_size: int, halo: int) -> list:
+    """returns the blocks covering a raster, each with a halo of context pixels around it
+
+    Args:
+        width (int): raster width
+        height (int): raster height
+        block_size (int): block width and height
+        halo (int): context around each block (px), clipped to the raster
+
+    Returns:
+        list: (block, padded) rasterio Windows; block is the part written, padded the part read
+    """
+    windows = []
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            block = Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+            col0, row0 = max(col_off - halo, 0), max(row_off - halo, 0)
+            col1 = min(col_off + block.width + halo, width)
+            row1 = min(row_off + block.height + halo, height)
+            windows.append((block, Window(col0, row0, col1 - col0, row1 - row0)))
+    return windows
+
+
+def get_small_regions(regions: np.ndarray, min_size: int, open_edges: tuple = None) -> np.ndarray:
+    """returns the pixels of the regions smaller than min_size px, leaving out the regions that touch
+    an open edge of the image: the sides of a block cut from a larger raster, where a region may
+    continue beyond the block and is only partly counted
+
+    Args:
+        regions (np.ndarray): (height, width) labelled regions, e.g. from skimage.measure.label
+        min_size (int): area of the smallest region kept (px)
+        open_edges (tuple, optional): (top, bottom, left, right), True for the sides of the image
+            that are not the edge of the raster. Defaults to None (the image is the whole raster).
+
+    Returns:
+        np.ndarray: (height, width) bool mask of the small regions
+    """
+    small = np.bincount(regions.ravel()) < min_size
+    if open_edges is not None:
+        top, bottom, left, right = open_edges
+        for touches, edge in [(top, regions[0]), (bottom, regions[-1]), (left, regions[:, 0]), (right, regions[:, -1])]:
+            if touches:
+                small[np.unique(edge)] = False
+    return small[regions]
+
+
+def clean_label(label: np.ndarray, minblobsize: int, opening_disk_radius: int, nodata=None, open_edges: tuple = None) -> np.ndarray:
+    """fills holes of up to minblobsize px in each class of a label image, then applies a
+    morphological opening (disk of opening_disk_radius px) to each class, and takes the first
+    class left at each pixel. Pixels left without a class by the opening keep their label,
+    and nodata pixels are left as they are
+
+    Args:
+        label (np.ndarray): (height, width) integer label image
+        minblobsize (int): area of the largest hole filled (px)
+        opening_disk_radius (int): radius of the opening (px)
+        nodata (optional): nodata value of label. Defaults to None.
+        open_edges (tuple, optional): sides of label cut from a larger raster, holes touching them
+            are not filled (see get_small_regions). Defaults to None.
+
+    Returns:
+        np.ndarray: cleaned label image
+    """
+    classes = [c for c in np.unique(label) if c != nodata]
+    if len(classes) < 2:
+        return label
+
+    lstack = np.zeros((len(classes),) + label.shape, dtype=bool)
+    for i, c in enumerate(classes):
+        mask = label == c
+        # holes of up to minblobsize px, as remove_small_holes(mask, area_threshold=minblobsize)
+        holes = label_components(~mask, connectivity=1)
+        lstack[i] = mask | (get_small_regions(holes, minblobsize + 1, open_edges) & (holes > 0))
+        if opening_disk_radius > 0:
+            lstack[i] = opening(lstack[i], disk(opening_disk_radius))
+
+    cleaned = np.asarray(classes, dtype=label.dtype)[np.argmax(lstack, axis=0)]
+    keep = ~np.any(lstack, axis=0)
+    if nodata is not None:
+        keep |= label == nodata
+    cleaned[keep] = label[keep]
+    return cleaned
+
+
+def fill_from_nearest(label: np.ndarray, unknown: np.ndarray) -> np.ndarray:
+    """returns label with the unknown pixels set to the label of the nearest known pixel"""
+    if not np.any(unknown) or np.all(unknown):
+        return label
+    indices = ndimage.distance_transform_edt(unknown, return_distances=False, return_indices=True)
+    return label[tuple(indices)]
+
+
+def fill_from_surrounding(label: np.ndarray, regions: np.ndarray, unknown: np.ndarray, known: np.ndarray) -> np.ndarray:
+    """returns label with each region of unknown pixels set to the most common label of the known pixels
+    around it (its 4-connected ring, each pixel counted once; ties go to the smallest label).
+    Regions without a known pixel around them keep their label
+
+    Args:
+        label (np.ndarray): (height, width) integer label image
+        regions (np.ndarray): (height, width) labelled regions of label, 4-connected (skimage.measure.label)
+        unknown (np.ndarray): (height, width) bool mask of the pixels of the regions to relabel
+        known (np.ndarray): (height, width) bool mask of the pixels that may vote
+
+    Returns:
+        np.ndarray: relabelled label image
+    """
+    index = np.arange(label.size).reshape(label.shape)
+    # (pixel of a region, neighbour) pairs, in each of the 4 directions
+    neighbours = [
+        ((slice(1, None), slice(None)), (slice(None, -1), slice(None))),
+        ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+        ((slice(None), slice(1, None)), (slice(None), slice(None, -1))),
+        ((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+    ]
+    region_ids, ring = [], []
+    for inside, outside in neighbours:
+        pairs = unknown[inside] & known[outside]
+        region_ids.append(regions[inside][pairs])
+        ring.append(index[outside][pairs])
+    region_ids, ring = np.concatenate(region_ids), np.concatenate(ring)
+    cleaned = label.copy()
+    if len(ring) == 0:
+        return cleaned
+
+    # each ring pixel once per region, then the count of each label around each region
+    region_ids, ring = np.unique(np.stack((region_ids, ring)), axis=1)
+    (region_ids, ring_labels), counts = np.unique(np.stack((region_ids, label.ravel()[ring].astype(region_ids.dtype))), axis=1, return_counts=True)
+    # most common label first in each region
+    order = np.lexsort((ring_labels, -counts, region_ids))
+    region_ids, first = np.unique(region_ids[order], return_index=True)
+
+    majority = np.zeros(regions.max() + 1, dtype=label.dtype)
+    majority[region_ids] = ring_labels[order][first]
+    surrounded = np.zeros(regions.max() + 1, dtype=bool)
+    surrounded[region_ids] = True
+    relabel = unknown & surrounded[regions]
+    cleaned[relabel] = majority[regions[relabel]]
+    return cleaned
+
+
+def clean_label_components(label: np.ndarray, minblobsize: int, opening_disk_radius: int, nodata=None, open_edges: tuple = None) -> np.ndarray:
+    """cleans a label image like clean_label, working on the integer label image (no one-hot stack),
+    so memory is O(pixels) rather than O(pixels x classes):
+
+    1. connected regions of the same label of up to minblobsize px (holes and islands of any class), the
+       same threshold as the holes of clean_label, are given the most common label of the pixels around
+       them, other small regions and nodata left out (fill_from_surrounding). Small regions with nothing
+       else around them are given the label of the nearest pixel left
+    2. each class is opened with a disk of opening_disk_radius px through two distance transforms
+       (erosion: farther than the radius from the rest of the image, dilation: within the radius of
+       the eroded class), and the pixels removed are given the label of the nearest pixel left
+
+    Args:
+        label (np.ndarray): (height, width) integer label image
+        minblobsize (int): area of the largest region relabelled (px)
+        opening_disk_radius (int): radius of the opening (px)
+        nodata (optional): nodata value of label, left as it is. Defaults to None.
+        open_edges (tuple, optional): sides of label cut from a larger raster, regions touching them
+            are not relabelled (see get_small_regions). Defaults to None.
+
+    Returns:
+        np.ndarray: cleaned label image
+    """
+    valid = np.ones(label.shape, dtype=bool) if nodata is None else label != nodata
+
+    # 1. small regions
+    regions = label_components(label.astype(np.int64), background=-1 if nodata is None else int(nodata), connectivity=1)
+    unknown = get_small_regions(regions, minblobsize + 1, open_edges) & valid
+    cleaned = fill_from_surrounding(label, regions, unknown, valid & ~unknown)
+    # a relabelled region always changes label (its ring has none of its own), so those left are unchanged
+    unknown &= cleaned == label
+    if np.any(unknown):
+        filled = fill_from_nearest(cleaned, unknown | ~valid)
+        cleaned[unknown] = filled[unknown]
+
+    # 2. opening
+    if opening_disk_radius > 0:
+        unknown = np.zeros(label.shape, dtype=bool)
+        for c in np.unique(cleaned[valid]):
+            mask = cleaned == c
+            eroded = ndimage.distance_transform_edt(mask) > opening_disk_radius
+            if np.any(eroded):
+                opened = ndimage.distance_transform_edt(~eroded) <= opening_disk_radius
+            else:
+                opened = eroded
+            unknown |= mask & ~opened
+        if not np.all(unknown[valid]):
+            filled = fill_from_nearest(cleaned, unknown | ~valid)
+            cleaned[unknown] = filled[unknown]
+    return cleaned
+
+
+def clean_block(label_ortho: str, block: Window, padded: Window, minblobsize: int, opening_disk_radius: int, mode: str = "onehot") -> tuple:
+    """reads a block of a label raster with its halo, cleans it, and returns the block
+
+    Args:
+        label_ortho (str): full path to label raster
+        block (Window): block to clean
+        padded (Window): block with its halo, from get_block_windows
+        minblobsize (int): see clean_label
+        opening_disk_radius (int): see clean_label
+        mode (str, optional): "onehot" (clean_label) or "components" (clean_label_components). Defaults to "onehot".
+
+    Returns:
+        tuple: block, cleaned (block.height, block.width) label
+    """
+    with rasterio.open(label_ortho) as dataset:
+        label = dataset.read(1, window=padded)
+        nodata = dataset.nodata
+        width, height = dataset.width, dataset.height
+
+    # sides of the padded block inside the raster
+    open_edges = (
+        padded.row_off > 0,
+        padded.row_off + padded.height < height,
+        padded.col_off > 0,
+        padded.col_off + padded.width < width,
+    )
+    if mode == "components":
+        cleaned = clean_label_components(label, minblobsize, opening_disk_radius, nodata, open_edges)
+    else:
+        cleaned = clean_label(label, minblobsize, opening_disk_radius, nodata, open_edges)
+    row0 = block.row_off - padded.row_off
+    col0 = block.col_off - padded.col_off
+    return block, cleaned[row0:row0+block.height, col0:col0+block.width]
+
+
+def clean_label_raster(
+    label_ortho: str,
+    out_file: str,
+    minblobsize: int,
+    opening_disk_radius: int,
+    block_size: int = 2048,
+    halo: int = None,
+    num_workers: int = None,
+    mode: str = "onehot",
+) -> None:
+    """cleans a label mosaic block by block (see clean_label) on a pool of processes,
+    writing the cleaned blocks to out_file through rasterio windows as they complete.
+    Memory is bounded by a few blocks per worker, not by the mosaic size
+
+    Each block is read with a halo of context pixels so the opening is the same as on the full
+    raster, and small regions near the block are seen whole. Regions that reach the edge of the halo
+    may continue beyond it, so they are never taken for small ones (see get_small_regions)
+
+    Args:
+        label_ortho (str): full path to label mosaic (one band, integer classes)
+        out_file (str): full path to output GeoTIFF
+        minblobsize (int): area of the largest hole filled (px)
+        opening_disk_radius (int): radius of the opening (px)
+        block_size (int, optional): block width and height. Defaults to 2048.
+        halo (int, optional): context around each block (px). Defaults to minblobsize + 2 * opening_disk_radius:
+            a small region reaching into the block spans at most minblobsize - 1 px beyond it, so it is seen whole,
+            and the opening of the filled classes reaches 2 * opening_disk_radius px further.
+        num_workers (int, optional): number of processes. Defaults to os.cpu_count().
+        mode (str, optional): "onehot" (clean_label, one mask per class) or "components"
+            (clean_label_components, on the label image). Defaults to "onehot".
+    """
+    if halo is None:
+        halo = minblobsize + 2 * opening_disk_radius
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    with rasterio.open(label_ortho) as dataset:
+        profile = dataset.profile
+        width, height = dataset.width, dataset.height
+        try:
+            colormap = dataset.colormap(1)
+        except ValueError:
+            colormap = None
+    profile.update(driver="GTiff", count=1, tiled=True, blockxsize=256, blockysize=256, compress="lzw", BIGTIFF="IF_SAFER")
+
+    windows = get_block_windows(width, height, block_size, halo)
+    print("Cleaning {} blocks on {} processes ...".format(len(windows), num_workers))
+
+    with rasterio.open(out_file, "w", **profile) as out, ProcessPoolExecutor(max_workers=num_workers) as executor:
+        if colormap is not None:
+            out.write_colormap(1, colormap)
+
+        def write_blocks(futures):
+            for future in futures:
+                block, cleaned = future.result()
+                out.write(cleaned, 1, window=block)
+
+        pending = set()
+        for block, padded in windows:
+            # bound the number of cleaned blocks held in memory
+            if len(pending) >= 2 * num_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_blocks(done)
+            pending.add(executor.submit(clean_block, label_ortho, block, padded, minblobsize, opening_disk_radius, mode))
+        write_blocks(wait(pending)[0])
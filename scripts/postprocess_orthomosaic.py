@@ -26,12 +26,10 @@
 # standard imports
 from tkinter import filedialog
 from tkinter import *
+import os
 
-## other imports
-import rasterio 
-from skimage.morphology import disk
-from skimage.morphology import disk, opening, dilation, area_closing, area_opening, remove_small_holes, remove_small_objects
-import numpy as np
+# local imports
+import postprocess_funcs
 
 ###############################################
 ################# INPUTS
@@ -50,62 +48,33 @@ import numpy as np
 # print("Min. patch size : {}".format(minblobsize))
 
 minblobsize = 10000
-
-### user inputs
-# Request the orthomosaic geotiff file
-root = Tk()
-root.filename =  filedialog.askopenfilename(title = "Select label orthomosaic file",filetypes = (("geotff file","*.tif"),("jpeg file (with xml and/or wld)","*.jpg")))
-label_ortho = root.filename
-print(label_ortho)
-root.withdraw()
-
-
-
-
-### read mosaic into memory
-print("Read mosaic into memory ...")
-with rasterio.open(label_ortho) as dataset:
-    # Read the dataset's valid data mask as a ndarray.
-    label_raster = dataset.read()
-    profile = dataset.profile
-
-label_raster = np.squeeze(label_raster)
-
-## one-hot encode to make one 2d raster per class
-print("One-hot encode mosaic ...")
-nR,nC = label_raster.shape
-k=np.unique(label_raster.flatten())
-
-NCLASSES = np.max(k)+1
-lstack = np.zeros((nR,nC,NCLASSES), dtype=np.uint8)
-lstack[:,:,:NCLASSES+1] = (np.arange(NCLASSES) == 1+label_raster[...,None]-1).astype(int) 
-
-# del label_raster
-print("Removing small holes in each class label ...")
-lstack0 = lstack.copy()
-lstack0 = lstack0.astype(np.uint8)
-lstack0[lstack0==1]=255
-for i in range(NCLASSES):
-    lstack0[:,:,i] = remove_small_holes(lstack0[:,:,i], area_threshold=minblobsize) #min_size=minblobsize)
-
-print("Morphological opening on each class label ...")
 opening_disk_radius = 10 ##m for a 1m naip raster
-for i in range(NCLASSES):
-    lstack0[:,:,i] = opening(lstack0[:,:,i], disk(opening_disk_radius)) 
-
-## v slow
-
-label_raster2 = np.argmax(lstack0,-1)
-
-plt.subplot(121)
-plt.imshow(label_raster[:1000,:1000]); plt.axis('off')
-
-plt.subplot(122)
-plt.imshow(label_raster2[:1000,:1000]); plt.axis('off')
-plt.show()
-
-
-
 
-plt.imshow(label_raster[:1000,:1000] - label_raster2[:1000,:1000]); plt.axis('off')
-plt.show()
\ No newline at end of file
+block_size = 2048 ## the mosaic is cleaned in blocks of this many pixels (plus a halo of 2 x opening_disk_radius)
+num_workers = None ## number of processes cleaning blocks. None = all CPUs
+mode = 'components' ## 'components' cleans the label image directly (memory ~ pixels), 'onehot' one mask per class (memory ~ pixels x classes)
+
+if __name__ == "__main__":
+
+    ### user inputs
+    # Request the orthomosaic geotiff file
+    root = Tk()
+    root.filename =  filedialog.askopenfilename(title = "Select label orthomosaic file",filetypes = (("geotff file","*.tif"),("jpeg file (with xml and/or wld)","*.jpg")))
+    label_ortho = root.filename
+    print(label_ortho)
+    root.withdraw()
+
+    out_file = os.path.splitext(label_ortho)[0] + '_clean.tif'
+
+    ### remove small holes (or blobs) in each class label, then a morphological opening on each class label,
+    ### block by block in parallel, without reading the mosaic into memory
+    postprocess_funcs.clean_label_raster(
+        label_ortho,
+        out_file,
+        minblobsize,
+        opening_disk_radius,
+        block_size=block_size,
+        num_workers=num_workers,
+        mode=mode
+    )
+    print("Cleaned label mosaic written to {}".format(out_file))
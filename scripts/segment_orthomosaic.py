@@ -35,6 +35,7 @@ from glob import glob
 # local imports
 import model_data_funcs
 import model_inference_funcs
+import orthomosaic_funcs
 from model_inference_funcs import tf
 
 ## geospatial imports
@@ -43,7 +44,6 @@ gdal.SetCacheMax(2**30) # max out the cache
 
 ###### user variables
 ####========================
-# resampleAlg = 'mode' # alternatives = # 'nearest', 'max', 'min', 'average', 'gauss'
 # TARGET_SIZE = 1024 #768
 
 # do_parallel = True 
@@ -53,10 +53,25 @@ do_parallel = False
 profile = 'meta' ## predseg + meta 
 # profile = 'minimal' ## predseg
 
-## profile must be 'meta' or 'full' for this script to work
+## profile must be 'meta' or 'full' for this script to work, unless blend = None
 
 make_RGB_label_ortho = True # make an RGB label mosaic as well as a greyscale one
-make_jpeg = False ## make JPEG mosaics as well as geotiffs
+make_jpeg = False ## make a JPEG of the RGB label mosaic as well as the geotiff
+cog = True ## write the mosaics as Cloud Optimized GeoTIFFs with internal overviews, for fast previews at any scale
+blend = 'hann' ## weighting of overlapping tile scores before the argmax. 'hann' (cosine taper) or 'mean'.
+## None (tiles only) mosaics the georeferenced label tiles written by the model instead, no scores mosaic
+prob_dtype = 'float32' ## Mosaic_Prob.tif (one band per class) as 'float32', or 'uint8' quantised 0-255 (scale 1/255 in its metadata, 4x smaller)
+## the scores in the tiles' "_res.npz" files are stored as prob_dtype too ('float16' halves them, mosaic stays float32)
+
+batch_size = None ## number of tiles per model forward pass. None = pick from available memory
+fuse_ensemble = False ## True = run ENSEMBLE models as a single averaged model
+trace_models = False ## True = trace the models once, with a fixed input shape, before the first tile
+fast_resize = False ## True = average model outputs before a single float32 upsample to the tile size
+skip_empty_tiles = True ## skip all-nodata (or constant) tiles in inference and stitching
+streaming = False ## True = segment the ortho window by window straight into Mosaic.tif and Mosaic_Prob.tif, without tile files
+overlap_fraction = 0.5 ## overlap of neighbouring tiles, as a fraction of TARGET_SIZE (stride = TARGET_SIZE - overlap). 0.5 infers ~4x the tiles of 0
+write_tiles = False ## with streaming = False, write georeferenced jpeg tiles and segment them from disk, instead of passing the tiles to the model in memory
+dry_run = False ## only print the tile count, estimated inference time and scratch disk of each ortho, for several overlaps
 
 #===============================
 
@@ -91,28 +106,6 @@ if __name__ == "__main__":
     print("You chose TARGET_SIZE : {}".format(TARGET_SIZE))
 
 
-    ### choose resampleAlg 
-    root = Tk()
-    root.geometry('200x100')
-
-    choices = [
-        "nearest",
-        "mode",
-        "min",
-        "max",
-        "average",
-        "gauss"
-    ]
-
-    variable = StringVar(root)
-    variable.set("mode")
-    w = OptionMenu(root, variable, *choices)
-    w.pack()
-    root.mainloop()
-
-    resampleAlg = variable.get()
-    print("You chose resample algorithm : {}".format(resampleAlg))
-
     #### choose generic task 
     root = Tk()
     root.geometry('200x100')
@@ -276,8 +269,10 @@ if __name__ == "__main__":
     print(image_ortho)
     root.withdraw()
 
-    OVERLAP_PX = TARGET_SIZE//2
-    print("Overlap size : {} px".format(OVERLAP_PX))
+    ## tiles are cut at the size chosen above, TARGET_SIZE is later set from the model config
+    TILE_SIZE = TARGET_SIZE
+    OVERLAP_PX = int(TILE_SIZE*overlap_fraction)
+    print("Overlap size : {} px, stride : {} px".format(OVERLAP_PX, TILE_SIZE-OVERLAP_PX))
 
 
 
@@ -319,7 +314,14 @@ if __name__ == "__main__":
         outdir = indir+os.sep+'tiles'
         # outdir = indir+os.sep+'tiles_copy'
 
-        if os.path.isdir(os.path.normpath(outdir)):
+        if streaming or dry_run:
+            print("Streaming segmentation or dry run ... no tiles made")
+
+        elif not write_tiles:
+            print("Tiles are passed to the model in memory ... no tiles made")
+            os.makedirs(outdir, exist_ok=True)
+
+        elif os.path.isdir(os.path.normpath(outdir)):
             print(f"{outdir} already exists ... skipping tile creation")
 
         else:
@@ -329,53 +331,37 @@ if __name__ == "__main__":
                 pass
 
             ### chop up image ortho into tiles with 50% overlap
+            ### tiles are read from the ortho in-process with gdal, and written
+            ### straight to georeferenced jpegs for the Zoo model
+            ### (jpg + jpg.aux.xml, as gdal_retile.py then gdal_translate used to make)
+
+            n_tiles = 0
+            for tile in orthomosaic_funcs.iter_tiles(image_ortho, TILE_SIZE, OVERLAP_PX, bands=[1,2,3]):
+                orthomosaic_funcs.write_tile(
+                    outdir+os.sep+tile["name"]+'.jpg', tile["image"], tile["geotransform"], tile["projection"], driver='JPEG'
+                )
+                n_tiles += 1
+
+            if n_tiles==0:
+                print("No tiles made")
+                sys.exit(0)
+            print("{} tiles made".format(n_tiles))
 
-            if os.name == "nt":
-
-                try:
-                    print("Attempting to use gdal from conda env")
-                    cmd = 'python gdal_retile.py -r near -ot Byte -ps {} {} -overlap {} -co "tiled=YES" -targetDir {} {}'.format(TARGET_SIZE,TARGET_SIZE,OVERLAP_PX,outdir,image_ortho)
-                    os.system(cmd)
-                except:
-                    print("That didn't work. Attempting to use gdal from osgeo4w")
-                    from subprocess import Popen, PIPE
-                    process=Popen(["python","C:\\OSGeo4W64\\bin\\gdal_retile.py","-r", "near", "-ot", "Byte","-ps",str(TARGET_SIZE),str(TARGET_SIZE),"-overlap",str(OVERLAP_PX),"-co", "tiled=YES","-targetDir",outdir, image_ortho], stdout=PIPE, stderr=PIPE)
-                    stdout, stderr = process.communicate()
-
-            else:
-                try:
-                    ## it would be cleaner if the gdal_retile.py script could be wrapped in gdal/osgeo python, but it errored for me ...
-                    cmd = 'gdal_retile.py -r near -ot Byte -ps {} {} -overlap {} -co "tiled=YES" -targetDir {} {}'.format(TARGET_SIZE,TARGET_SIZE,OVERLAP_PX,outdir,image_ortho)
-                    os.system(cmd)
-                except:
-                    cmd = 'python gdal_retile.py -r near -ot Byte -ps {} {} -overlap {} -co "tiled=YES" -targetDir {} {}'.format(TARGET_SIZE,TARGET_SIZE,OVERLAP_PX,outdir,image_ortho)
-                    os.system(cmd)
-
-            ### convert to jpegs for Zoo model
-            kwargs = {
-                'format': 'JPEG',
-                'outputType': gdal.GDT_Byte
-            }
-
-            def gdal_translate_jpeg(f, bandList, kwargs):
-                ds = gdal.Translate(f.replace('.tif','.jpg'), f, bandList=bandList, **kwargs)
-                ds = None # close and save ds
-
-            files_to_convert = glob(outdir+os.sep+'*.tif')
-
-            bandList=[1,2,3]
-
-            if len(files_to_convert)>0:
-
-                for f in files_to_convert:
-                    gdal_translate_jpeg(f, bandList, kwargs)
+        ##################################
+        ##### STEP 2b: INDEX EMPTY TILES
 
-                ## delete tif files
-                _ = [os.remove(k) for k in glob(outdir+os.sep+'*.tif')]
+        ### tiles that are all nodata (or constant), e.g. in the collar of the ortho,
+        ### are skipped by the model and left out of the mosaics
 
-            else:
-                print("No tif files found")
-                sys.exit(0)
+        if skip_empty_tiles and write_tiles and not (streaming or dry_run):
+            empty_tiles = orthomosaic_funcs.get_empty_tile_index(
+                model_inference_funcs.sort_files(outdir),
+                os.path.join(outdir, 'empty_tiles.json'),
+                nodata=orthomosaic_funcs.get_nodata_value(image_ortho)
+            )
+            print("{} empty tiles will be skipped".format(len(empty_tiles)))
+        else:
+            empty_tiles = []
 
         ##################################
         ##### STEP 3: MAKE LABEL TILES
@@ -450,12 +436,88 @@ if __name__ == "__main__":
         metadatadict["model_types"] = model_names
         print(f"\n metadatadict:\n {metadatadict}")
 
+        if dry_run:
+            if not "TESTTIMEAUG" in locals():
+                TESTTIMEAUG = False
+
+            ### time the models on the first tiles of the ortho, and print the cost of a few overlaps
+            seconds_per_tile = orthomosaic_funcs.measure_seconds_per_tile(
+                image_ortho,
+                model_inference_funcs.get_fused_ensemble(model_list, MODEL) if fuse_ensemble else model_list,
+                MODEL,
+                NCLASSES,
+                N_DATA_BANDS,
+                TARGET_SIZE,
+                TESTTIMEAUG,
+                OVERLAP_PX,
+                batch_size=batch_size or 1,
+                tile_size=TILE_SIZE
+            )
+            orthomosaic_funcs.print_tiling_report(
+                image_ortho,
+                TILE_SIZE,
+                sorted(set([0, TILE_SIZE//4, TILE_SIZE//2, OVERLAP_PX])),
+                NCLASSES,
+                seconds_per_tile,
+                streaming=streaming
+            )
+            continue
+
+        if streaming:
+            # look for TTA config
+            if not "TESTTIMEAUG" in locals():
+                print("TESTTIMEAUG not found in config file(s). Setting to False")
+                TESTTIMEAUG = False
+
+            ##################################
+            ##### STEPS 3-6: SEGMENT THE ORTHO WINDOW BY WINDOW
+
+            outTIF = os.path.join(indir, 'Mosaic.tif')
+            outTIFprob = os.path.join(indir, 'Mosaic_Prob.tif')
+
+            orthomosaic_funcs.segment_orthomosaic(
+                image_ortho,
+                outTIF,
+                outTIFprob,
+                model_list,
+                MODEL,
+                NCLASSES,
+                N_DATA_BANDS,
+                TARGET_SIZE,
+                TESTTIMEAUG,
+                OVERLAP_PX,
+                batch_size=batch_size,
+                blend=blend or 'mean',
+                fuse_ensemble=fuse_ensemble,
+                trace_models=trace_models,
+                colormap=model_inference_funcs.CLASS_LABEL_COLORMAP,
+                prob_dtype=prob_dtype,
+                cog=cog,
+                tile_size=TILE_SIZE
+            )
+
+            if make_RGB_label_ortho:
+                orthomosaic_funcs.write_label_rgb(outTIF, os.path.join(indir, 'MosaicRGB.tif'), driver='COG' if cog else 'GTiff')
+                if make_jpeg:
+                    orthomosaic_funcs.write_label_rgb(outTIF, os.path.join(indir, 'MosaicRGB.jpg'), driver='JPEG', options=["QUALITY=100"])
+            continue
+
         #####################################
         # read images
         #####################################
 
-        sample_filenames = model_inference_funcs.sort_files(sample_direc)
-        print("Number of samples: %i" % (len(sample_filenames)))
+        if write_tiles:
+            sample_filenames = model_inference_funcs.sort_files(sample_direc)
+            print("Number of samples: %i" % (len(sample_filenames)))
+            tiles = None
+        else:
+            ### lossless handoff: tiles are read from the ortho and passed to the model as arrays,
+            ### empty tiles are dropped as they are read
+            nodata = orthomosaic_funcs.get_nodata_value(image_ortho)
+            tiles = (
+                tile for tile in orthomosaic_funcs.iter_tiles(image_ortho, TILE_SIZE, OVERLAP_PX, bands=[1,2,3])
+                if not (skip_empty_tiles and orthomosaic_funcs.is_empty_image(tile["image"], nodata))
+            )
 
         #####################################
         #### run model on each image in a for loop
@@ -493,7 +555,16 @@ if __name__ == "__main__":
                 model_list,
                 metadatadict,
                 profile,
-                out_dir_name
+                out_dir_name,
+                batch_size=batch_size,
+                fuse_ensemble=fuse_ensemble,
+                trace_models=trace_models,
+                fast_resize=fast_resize,
+                files_to_skip=empty_tiles,
+                images=tiles,
+                write_label_tif=blend is None,
+                prob_dtype=prob_dtype,
+                lean_metadata=True
             )
         except Exception as e:
             print(e)
@@ -515,166 +586,60 @@ if __name__ == "__main__":
         # "overlay.png" files ...
         _ = [os.remove(k) for k in glob(outdir+os.sep+out_dir_name+os.sep+'*overlay.png')]
 
-        ###############################################
-        ################# LABEL ORTHO CREATION PREP
-
-        ### the trick here is to make asure all the png files and xml files are
-        ### in the same directoy and have the same filename root
-
-        # Get imgs list
-        imgsToMosaic = sorted(glob(os.path.join(outdir, out_dir_name, '*.png')))
-
-        ## copy the xml files into the 'out' folder
-        xml_files = sorted(glob(os.path.join(outdir, '*.xml')))
-
-        for k in xml_files:
-            shutil.copyfile(k,k.replace(outdir,outdir+os.sep+out_dir_name)) #'out'))
-
-        ## rename pngs
-        for k in imgsToMosaic:
-            os.rename(k,k.replace('_predseg',''))
-
-        xml_files = sorted(glob(os.path.join(outdir,out_dir_name, '*.xml')))
-        ## rename xmls
-        for k in xml_files:
-            os.rename(k, k.replace('.jpg.aux.xml', '.png.aux.xml'))
-
-        ###############################################
-        ################# LABEL ORTHO CREATION 
-        ### let's stitch the label "predseg" pngs!
-
-        # make some output paths
-        if make_RGB_label_ortho:
-            outVRTrgb = os.path.join(indir, 'MosaicRGB.vrt')
-            outTIFrgb = os.path.join(indir, 'MosaicRGB.tif')
-            if make_jpeg:
-                outJPGrgb = os.path.join(indir, 'MosaicRGB.jpg')
-
-        outVRT = os.path.join(indir, 'Mosaic.vrt')
         outTIF = os.path.join(indir, 'Mosaic.tif')
-        if make_jpeg:
-            outJPG = os.path.join(indir, 'Mosaic.jpg')
 
-        if make_RGB_label_ortho:
-            ## now we have pngs and png.xml files with the same names in the same folder
-            imgsToMosaic = sorted(glob(os.path.join(outdir, out_dir_name, '*.png')))
-            print('{} images to mosaic'.format(len(imgsToMosaic)))
+        if blend is None:
+            ###############################################
+            ################# LABEL ORTHO CREATION
+            ### the model wrote a georeferenced uint8 label tile ("_label.tif") next to each colour label,
+            ### mosaic them as they are (where tiles overlap, the last one wins)
 
-            # First build vrt for geotiff output
-            vrt_options = gdal.BuildVRTOptions(resampleAlg=resampleAlg, srcNodata=0, VRTNodata=0)
-            ds = gdal.BuildVRT(outVRTrgb, imgsToMosaic, options=vrt_options)
-            ds.FlushCache()
-            ds = None
+            imgsToMosaic = sorted(glob(os.path.join(outdir, out_dir_name, '*_label.tif')))
+            print('{} images to mosaic'.format(len(imgsToMosaic)))
 
-            # then build tiff
-            ds = gdal.Translate(destName=outTIFrgb, creationOptions=["NUM_THREADS=ALL_CPUS", "COMPRESS=LZW", "TILED=YES"], srcDS=outVRTrgb)
+            outVRT = os.path.join(indir, 'Mosaic.vrt')
+            vrt_options = gdal.BuildVRTOptions(srcNodata=0, VRTNodata=0)
+            ds = gdal.BuildVRT(outVRT, imgsToMosaic, options=vrt_options)
             ds.FlushCache()
             ds = None
 
-            if make_jpeg:
-                # now build jpeg (optional)
-                ds = gdal.Translate(destName=outJPGrgb, creationOptions=["NUM_THREADS=ALL_CPUS", "COMPRESS=JPG", "TILED=YES", "TFW=YES", "QUALITY=100"], srcDS=outVRTrgb)
-                ds.FlushCache()
-                ds = None
-
-        ##################################
-        ##### STEP 5: MAKE AND STITCH ORTHO GREYSCALE LABEL TILES
-
-        ## okay, now let's make the greyscale label mosaic
-
-        npzs = sorted(glob(os.path.join(outdir, out_dir_name, '*.npz')))
-
-        def write_greylabel_to_png(k):
-            with np.load(k) as data:
-                dat = 1+np.round(data['grey_label'].astype('uint8'))
-            imsave(k.replace('.npz','.png'), dat, check_contrast=False, compression=0)
-
-        for k in npzs:
-            write_greylabel_to_png(k)
-            
-        ## now we have pngs and png.xml files with the same names in the same folder
-        imgsToMosaic = sorted(glob(os.path.join(outdir, out_dir_name, '*res.png')))
-        print('{} images to mosaic'.format(len(imgsToMosaic)))
-
-
-        xml_files = sorted(glob(os.path.join(outdir, out_dir_name, '*.xml')))
-        ## copy and name xmls
-        for k in xml_files:
-            shutil.copyfile(k,k.replace('.png','_res.png'))
-
-
-        # First build vrt for geotiff output
-        vrt_options = gdal.BuildVRTOptions(resampleAlg=resampleAlg, srcNodata=0, VRTNodata=0)
-        ds = gdal.BuildVRT(outVRT, imgsToMosaic, options=vrt_options)
-        ds.FlushCache()
-        ds = None
-
-        # then build tiff
-        ds = gdal.Translate(destName=outTIF, creationOptions=["NUM_THREADS=ALL_CPUS", "COMPRESS=LZW", "TILED=YES"], srcDS=outVRT)
-        ds.FlushCache()
-        ds = None
-
-        if make_jpeg:
-            # now build jpeg (optional)
-            ds = gdal.Translate(destName=outJPG, creationOptions=["NUM_THREADS=ALL_CPUS", "COMPRESS=JPG", "TILED=YES", "TFW=YES", "QUALITY=100"], srcDS=outVRT)
+            ds = gdal.Translate(destName=outTIF, creationOptions=["NUM_THREADS=ALL_CPUS", "COMPRESS=LZW", "TILED=YES"], srcDS=outVRT)
             ds.FlushCache()
             ds = None
+            if cog:
+                orthomosaic_funcs.write_cog(outTIF, "NEAREST")
 
-        ##################################
-        ##### STEP 6: MAKE AND STITCH ORTHO GREYSCALE probability TILES
-
-
-        def write_greyprobs_to_tif(k):
-            with np.load(k) as data:
-                dat = tf.nn.softmax(data['av_softmax_scores']).numpy().astype('float32')
-            if np.ndim(dat)==2:
-                NCLASSES=1
-            else:
-                NCLASSES = dat.shape[-1]
-            for i in range(NCLASSES):
-                if NCLASSES>1:
-                    imsave(k.replace('res.npz','prob'+str(i)+'.tif'), dat[:,:,i], check_contrast=False, compression=0)
-                else:
-                    imsave(k.replace('res.npz','prob'+str(i)+'.tif'), dat, check_contrast=False, compression=0)
-
-            return dat
-
-        # k=npzs[0]
-        # with np.load(k) as data:
-        #     dat = data['av_softmax_scores']
-
-        for k in npzs:
-            dat = write_greyprobs_to_tif(k)
-
-        xml_files = sorted(glob(os.path.join(outdir,out_dir_name, '*res*.xml')))
-        ## copy and name xmls
-        for i in range(dat.shape[-1]):
-            for k in xml_files:
-                shutil.copyfile(k,k.replace('_res.png','_prob'+str(i)+'.tif'))
-
-        if np.ndim(dat)==2:
-            NCLASSES=1
         else:
-            NCLASSES = dat.shape[-1]
-            
-        for i in range(NCLASSES):
-        # for i in range(dat.shape[-1]):
-            outVRT = os.path.join(indir, 'Mosaic_Prob'+str(i)+'.vrt')
-            outTIF = os.path.join(indir, 'Mosaic_Prob'+str(i)+'.tif')
-
-            ## now we have pngs and png.xml files with the same names in the same folder
-            imgsToMosaic = sorted(glob(os.path.join(outdir, out_dir_name, '*prob'+str(i)+'.tif')))
-            print('{} images to mosaic'.format(len(imgsToMosaic)))
+            ###############################################
+            ################# LABEL AND PROBABILITY ORTHO CREATION
+            ### blend the scores of the overlapping tiles and stitch them into Mosaic.tif (label)
+            ### and Mosaic_Prob.tif (scores). The "_res.npz" files are georeferenced by their tile
 
+            npzs = sorted(glob(os.path.join(outdir, out_dir_name, '*_res.npz')))
+            if write_tiles:
+                tile_files = [os.path.join(outdir, os.path.basename(k).replace('_res.npz', '.jpg')) for k in npzs]
+            else:
+                tile_files = None
+            print('{} images to mosaic'.format(len(npzs)))
 
-            # First build vrt for geotiff output
-            vrt_options = gdal.BuildVRTOptions(resampleAlg="lanczos",srcNodata=0, VRTNodata=0)
-            ds = gdal.BuildVRT(outVRT, imgsToMosaic, options=vrt_options)
-            ds.FlushCache()
-            ds = None
+            outTIFprob = os.path.join(indir, 'Mosaic_Prob.tif')
 
-            # then build tiff
-            ds = gdal.Translate(destName=outTIF, creationOptions=["NUM_THREADS=ALL_CPUS", "COMPRESS=LZW", "TILED=YES"], srcDS=outVRT)
-            ds.FlushCache()
-            ds = None
+            orthomosaic_funcs.stitch_tiles(
+                image_ortho,
+                npzs,
+                outTIF,
+                outTIFprob,
+                NCLASSES,
+                TILE_SIZE,
+                OVERLAP_PX,
+                blend=blend,
+                colormap=model_inference_funcs.CLASS_LABEL_COLORMAP,
+                prob_dtype=prob_dtype,
+                tile_files=tile_files,
+                cog=cog
+            )
 
+        if make_RGB_label_ortho:
+            orthomosaic_funcs.write_label_rgb(outTIF, os.path.join(indir, 'MosaicRGB.tif'), driver='COG' if cog else 'GTiff')
+            if make_jpeg:
+                orthomosaic_funcs.write_label_rgb(outTIF, os.path.join(indir, 'MosaicRGB.jpg'), driver='JPEG', options=["QUALITY=100"])
@@ -0,0 +1,4 @@
+# the modules under test are scripts, imported from the scripts folder as the scripts import each other
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
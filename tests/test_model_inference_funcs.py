@@ -0,0 +1,89 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+pytest.importorskip("transformers")
+pytest.importorskip("doodleverse_utils")
+
+import model_inference_funcs
+
+
+def get_result(NCLASSES, shape=(12, 10), seed=0):
+    """returns scores and label of one image, as predict_batch does"""
+    scores = model_inference_funcs.softmax(np.random.RandomState(seed).randn(*shape, NCLASSES))
+    result = {"av_softmax_scores": scores}
+    if NCLASSES == 2:
+        result["av_prob_stack"] = (scores[:, :, 1] + (1 - scores[:, :, 0])) / 2
+        result["grey_label"] = (result["av_prob_stack"] > 0.5).astype("uint8")
+    else:
+        result["av_prob_stack"] = scores
+        result["grey_label"] = np.argmax(scores, -1)
+    return result
+
+
+def write_and_load(tmp_path, result, NCLASSES, **kwargs):
+    """writes the "_res.npz" file of result with write_seg_outputs and reads it back"""
+    segfile = str(tmp_path / "image_predseg.png")
+    bigimage = np.full(result["grey_label"].shape + (3,), 128, dtype=np.uint8)
+    model_inference_funcs.write_seg_outputs(
+        str(tmp_path / "image.jpg"), segfile, result, bigimage, {}, NCLASSES, 3, True, profile="meta", **kwargs
+    )
+    return np.load(segfile.replace("_predseg.png", "_res.npz"))
+
+
+def test_softmax_probabilities():
+    scores = model_inference_funcs.softmax(np.array([[1000.0, 0.0], [0.0, 0.0]]))
+    np.testing.assert_allclose(scores, [[1, 0], [0.5, 0.5]], atol=1e-6)
+    assert scores.dtype == np.float32
+
+
+@pytest.mark.parametrize("prob_dtype, atol", [("float32", 0), ("float16", 1e-3), ("uint8", 0.5 / 255 + 1e-6)])
+def test_quantise_scores_round_trip(prob_dtype, atol):
+    scores = get_result(4)["av_softmax_scores"]
+    stored, prob_scale = model_inference_funcs.quantise_scores(scores, prob_dtype)
+    assert stored.dtype == np.dtype(prob_dtype)
+    np.testing.assert_allclose(stored.astype(np.float32) * prob_scale, scores, atol=atol)
+
+
+def test_quantise_scores_uint8_rejects_logits():
+    with pytest.raises(ValueError):
+        model_inference_funcs.quantise_scores(np.array([[-2.0, 3.0]]), "uint8")
+
+
+@pytest.mark.parametrize("NCLASSES", [2, 4])
+def test_load_scores_version_1(tmp_path, NCLASSES):
+    result = get_result(NCLASSES)
+    with write_and_load(tmp_path, result, NCLASSES) as data:
+        assert "metadata_version" not in data
+        for key in ["av_softmax_scores", "av_prob_stack"]:
+            np.testing.assert_allclose(model_inference_funcs.load_scores(data, key), result[key], rtol=1e-6)
+        np.testing.assert_array_equal(data["grey_label"], result["grey_label"])
+
+
+@pytest.mark.parametrize("NCLASSES", [2, 4])
+@pytest.mark.parametrize("prob_dtype, atol", [("float32", 1e-6), ("float16", 1e-3), ("uint8", 0.5 / 255 + 1e-6)])
+def test_load_scores_version_2(tmp_path, NCLASSES, prob_dtype, atol):
+    result = get_result(NCLASSES)
+    with write_and_load(tmp_path, result, NCLASSES, prob_dtype=prob_dtype, lean_metadata=True) as data:
+        assert int(data["metadata_version"]) == model_inference_funcs.METADATA_VERSION
+        # the scores are stored once
+        assert data["av_softmax_scores"].dtype == np.dtype(prob_dtype)
+        assert str(data["av_prob_stack"]) == "av_softmax_scores"
+        for key in ["av_softmax_scores", "av_prob_stack"]:
+            scores = model_inference_funcs.load_scores(data, key)
+            assert scores.dtype == np.float32
+            np.testing.assert_allclose(scores, result[key], atol=atol)
+
+
+def test_load_scores_dict():
+    result = get_result(2)
+    data = {"nclasses": 2, "metadata_version": 2, "av_prob_stack": "av_softmax_scores"}
+    data["av_softmax_scores"], data["prob_scale"] = model_inference_funcs.quantise_scores(result["av_softmax_scores"], "uint8")
+    np.testing.assert_allclose(model_inference_funcs.load_scores(data, "av_prob_stack"), result["av_prob_stack"], atol=1 / 255)
+
+
+def test_color_lut_cycles():
+    lut = model_inference_funcs.get_color_lut(25)
+    assert lut.shape == (25, 3) and lut.dtype == np.uint8
+    n = len(model_inference_funcs.CLASS_LABEL_COLORMAP)
+    np.testing.assert_array_equal(lut[n:], lut[:25 - n])
@@ -0,0 +1,94 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("osgeo")
+pytest.importorskip("tensorflow")
+
+import orthomosaic_funcs
+
+
+def coverage(xsize, ysize, windows):
+    """returns the number of windows covering each pixel"""
+    count = np.zeros((ysize, xsize), dtype=int)
+    for _, _, xoff, yoff, width, height in windows:
+        count[yoff:yoff+height, xoff:xoff+width] += 1
+    return count
+
+
+@pytest.mark.parametrize("xsize, ysize, tile_size, overlap", [
+    (1000, 700, 256, 0),
+    (1000, 700, 256, 128),
+    (1000, 700, 256, 64),
+    (256, 256, 256, 128),
+    (100, 50, 256, 128),
+    (257, 513, 256, 255),
+])
+def test_tile_windows_cover_raster(xsize, ysize, tile_size, overlap):
+    windows = orthomosaic_funcs.get_tile_windows(xsize, ysize, tile_size, overlap)
+    stride = tile_size - overlap
+    for row, col, xoff, yoff, width, height in windows:
+        assert xoff == (col - 1) * stride and yoff == (row - 1) * stride
+        assert 0 < width <= tile_size and 0 < height <= tile_size
+        assert xoff + width <= xsize and yoff + height <= ysize
+    assert np.all(coverage(xsize, ysize, windows) >= 1)
+
+
+def test_tile_windows_no_overlap_is_a_partition():
+    windows = orthomosaic_funcs.get_tile_windows(1000, 700, 256, 0)
+    assert np.all(coverage(1000, 700, windows) == 1)
+    assert len(windows) == 4 * 3
+
+
+def test_tile_windows_no_tile_inside_the_overlap():
+    # the last tile would only repeat the overlap of the one before it
+    windows = orthomosaic_funcs.get_tile_windows(384, 256, 256, 128)
+    assert [(w[2], w[4]) for w in windows] == [(0, 256), (128, 256)]
+
+
+@pytest.mark.parametrize("overlap", [-1, 256, 300])
+def test_tile_windows_bad_overlap(overlap):
+    with pytest.raises(ValueError):
+        orthomosaic_funcs.get_tile_windows(1000, 700, 256, overlap)
+
+
+@pytest.mark.parametrize("n", [1, 2, 7, 256])
+def test_blend_window_positive(n):
+    for blend in ["hann", "mean"]:
+        weights = orthomosaic_funcs.get_blend_window(n, blend)
+        assert weights.shape == (n,) and weights.dtype == np.float32
+        assert np.all(weights > 0) and np.all(weights <= 1)
+
+
+def test_hann_windows_sum_to_one_at_half_overlap():
+    # sin^2 + cos^2: with a stride of half the window, the weights of the two windows over a pixel sum to 1
+    n = 256
+    windows = orthomosaic_funcs.get_tile_windows(4 * n, n, n, n // 2)
+    total = np.zeros(4 * n, dtype=np.float32)
+    for _, _, xoff, _, width, _ in windows:
+        total[xoff:xoff+width] += orthomosaic_funcs.get_blend_window(width, "hann")
+    # every pixel but the outer half windows is covered by two windows
+    np.testing.assert_allclose(total[n // 2:-n // 2], 1, atol=1e-6)
+
+
+@pytest.mark.parametrize("blend", ["hann", "mean"])
+@pytest.mark.parametrize("overlap", [0, 64, 128])
+def test_blended_weights_sum_to_one(blend, overlap):
+    # the normalised weights of the windows over each pixel (as write_label_rows divides by the
+    # accumulated weights) sum to 1, so constant scores are blended back to the same constant
+    xsize, ysize, tile_size = 600, 400, 256
+    windows = orthomosaic_funcs.get_tile_windows(xsize, ysize, tile_size, overlap)
+    weight = np.zeros((ysize, xsize))
+    weighted = np.zeros((ysize, xsize))
+    for _, _, xoff, yoff, width, height in windows:
+        w = orthomosaic_funcs.get_blend_window(height, blend)[:, None] * orthomosaic_funcs.get_blend_window(width, blend)[None, :]
+        weight[yoff:yoff+height, xoff:xoff+width] += w
+        weighted[yoff:yoff+height, xoff:xoff+width] += 0.3 * w
+    assert np.all(weight > 0)
+    np.testing.assert_allclose(weighted / weight, 0.3, rtol=1e-6)
+
+
+def test_tiling_cost_counts_accumulator():
+    cost = orthomosaic_funcs.get_tiling_cost(1000, 1000, 256, 128, 9)
+    assert cost["accumulator_bytes"] == 1000 * 1000 * 10 * 4
+    assert cost["scratch_bytes"] >= cost["accumulator_bytes"]
+    assert cost["num_tiles"] == len(orthomosaic_funcs.get_tile_windows(1000, 1000, 256, 128))
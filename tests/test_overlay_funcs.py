@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("rasterio")
+pytest.importorskip("skimage")
+
+import overlay_funcs
+
+
+@pytest.mark.parametrize("width, height, scale, tile_size", [
+    (1000, 700, 1, 256),
+    (1000, 700, 2, 256),
+    (1000, 700, 3, 128),
+    (512, 512, 2, 256),
+    (5, 3, 4, 1024),
+])
+def test_preview_windows(width, height, scale, tile_size):
+    windows = overlay_funcs.get_preview_windows(width, height, scale, tile_size)
+    count = np.zeros((height, width), dtype=int)
+    for row, col, window, out_shape in windows:
+        count[window.row_off:window.row_off+window.height, window.col_off:window.col_off+window.width] += 1
+        # the window divided by scale, rounded up, never larger than a tile
+        assert out_shape == (int(np.ceil(window.height / scale)), int(np.ceil(window.width / scale)))
+        assert 0 < out_shape[0] <= tile_size and 0 < out_shape[1] <= tile_size
+    assert np.all(count == 1)
+
+    # the tiles of a row (column) add up to the decimated mosaic, so the previews tile without gaps
+    first_row = [w for w in windows if w[0] == 0]
+    first_col = [w for w in windows if w[1] == 0]
+    assert sum(w[3][1] for w in first_row) == -(-width // scale)
+    assert sum(w[3][0] for w in first_col) == -(-height // scale)
+
+
+def test_preview_windows_edges():
+    windows = overlay_funcs.get_preview_windows(1000, 700, 2, 256)
+    assert [(w[0], w[1]) for w in windows][:3] == [(0, 0), (0, 1), (1, 0)]
+    row, col, window, out_shape = windows[-1]
+    assert (row, col) == (1, 1)
+    assert (window.col_off, window.row_off, window.width, window.height) == (512, 512, 488, 188)
+    assert out_shape == (94, 244)
+
+
+def test_to_uint8():
+    image = np.array([[0, 500, 1000, 2000]], dtype=np.uint16)
+    np.testing.assert_array_equal(overlay_funcs.to_uint8(image, 1000), [[0, 127, 255, 255]])
+    image = np.array([[7]], dtype=np.uint8)
+    assert overlay_funcs.to_uint8(image, 1000) is image
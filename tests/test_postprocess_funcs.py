@@ -0,0 +1,122 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("skimage")
+rasterio = pytest.importorskip("rasterio")
+
+from skimage.measure import label as label_components
+
+import postprocess_funcs
+
+CLEANERS = [postprocess_funcs.clean_label, postprocess_funcs.clean_label_components]
+
+
+def test_small_regions():
+    regions = np.array([
+        [1, 1, 2, 2],
+        [1, 1, 2, 3],
+        [4, 4, 4, 4],
+    ])
+    # areas: 4, 3, 1, 4
+    np.testing.assert_array_equal(postprocess_funcs.get_small_regions(regions, 4), np.isin(regions, [2, 3]))
+    np.testing.assert_array_equal(postprocess_funcs.get_small_regions(regions, 5), np.ones(regions.shape, dtype=bool))
+    assert not np.any(postprocess_funcs.get_small_regions(regions, 1))
+
+
+def test_small_regions_open_edges():
+    regions = np.array([
+        [1, 2, 2],
+        [3, 3, 3],
+        [3, 3, 4],
+    ])
+    small = postprocess_funcs.get_small_regions(regions, 3, open_edges=(True, False, False, False))
+    # 1 and 2 touch the open top edge, they may continue beyond it
+    np.testing.assert_array_equal(small, regions == 4)
+    small = postprocess_funcs.get_small_regions(regions, 3, open_edges=(False, True, False, True))
+    np.testing.assert_array_equal(small, np.isin(regions, [1]))
+
+
+@pytest.mark.parametrize("clean", CLEANERS)
+def test_small_island_filled(clean):
+    label = np.ones((9, 9), dtype=np.uint8)
+    label[4, 3:5] = 2
+    cleaned = clean(label, 2, 0)
+    assert np.all(cleaned == 1)
+    # same threshold in both modes: regions of up to minblobsize px
+    np.testing.assert_array_equal(clean(label, 1, 0), label)
+
+
+def test_components_majority_of_surroundings():
+    # the island touches class 3 by one pixel and class 1 by the rest
+    label = np.ones((7, 7), dtype=np.uint8)
+    label[:, 4:] = 3
+    label[3, 3] = 2
+    cleaned = postprocess_funcs.clean_label_components(label, 1, 0)
+    assert cleaned[3, 3] == 1
+    np.testing.assert_array_equal(cleaned, np.where(np.arange(7) < 4, 1, 3)[None, :].repeat(7, 0))
+
+
+def test_components_adjacent_small_regions():
+    # two small regions next to each other take the class around both, not each other's
+    label = np.ones((7, 7), dtype=np.uint8)
+    label[3, 2] = 2
+    label[3, 3] = 3
+    assert np.all(postprocess_funcs.clean_label_components(label, 1, 0) == 1)
+
+
+@pytest.mark.parametrize("clean", CLEANERS)
+def test_nodata_unchanged(clean):
+    label = np.ones((8, 8), dtype=np.uint8)
+    label[:, :3] = 0
+    label[4, 5] = 2
+    cleaned = clean(label, 2, 0, nodata=0)
+    np.testing.assert_array_equal(cleaned[:, :3], 0)
+    assert cleaned[4, 5] == 1
+
+
+def test_components_only_nodata_around():
+    label = np.zeros((3, 3), dtype=np.uint8)
+    label[1, 1] = 1
+    np.testing.assert_array_equal(postprocess_funcs.clean_label_components(label, 4, 0, nodata=0), label)
+
+
+@pytest.mark.parametrize("clean", CLEANERS)
+def test_open_edges_not_filled(clean):
+    # a small region on an open edge may be part of a large one in the neighbouring block
+    label = np.ones((8, 8), dtype=np.uint8)
+    label[0, 3:5] = 2
+    np.testing.assert_array_equal(clean(label, 2, 0, open_edges=(True, False, False, False)), label)
+    assert np.all(clean(label, 2, 0, open_edges=(False, True, True, True)) == 1)
+
+
+@pytest.mark.parametrize("clean", CLEANERS)
+def test_opening_keeps_wide_regions(clean):
+    label = np.ones((16, 16), dtype=np.uint8)
+    label[:, 4:12] = 2
+    np.testing.assert_array_equal(clean(label, 0, 1), label)
+
+
+def test_components_opening_removes_thin_lines():
+    label = np.ones((16, 16), dtype=np.uint8)
+    label[:, 7] = 2
+    assert np.all(postprocess_funcs.clean_label_components(label, 0, 1) == 1)
+
+
+@pytest.mark.parametrize("mode, clean", zip(["onehot", "components"], CLEANERS))
+def test_raster_blocks_match_whole_image(tmp_path, mode, clean):
+    # cleaned block by block with the default halo, the label is the same as cleaned whole
+    rng = np.random.RandomState(0)
+    label = (rng.rand(48, 48) > 0.5).astype(np.uint8) + 1
+    for _ in range(2):
+        label = np.where(rng.rand(*label.shape) > 0.5, label, np.roll(label, 1, axis=0))
+    label[label_components(label, connectivity=1) % 7 == 0] = 3
+    minblobsize, radius = 4, 1
+
+    label_ortho, out_file = str(tmp_path / "label.tif"), str(tmp_path / "cleaned.tif")
+    profile = dict(driver="GTiff", width=48, height=48, count=1, dtype="uint8", transform=rasterio.transform.from_origin(0, 48, 1, 1))
+    with rasterio.open(label_ortho, "w", **profile) as dataset:
+        dataset.write(label, 1)
+    postprocess_funcs.clean_label_raster(label_ortho, out_file, minblobsize, radius, block_size=16, num_workers=1, mode=mode)
+    with rasterio.open(out_file) as dataset:
+        np.testing.assert_array_equal(dataset.read(1), clean(label, minblobsize, radius))